@@ -0,0 +1,186 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List
+
+from config import settings
+from database import (collect_movies_details, collect_persons_films,
+                      pool_options, select_genres, select_movies,
+                      select_movies_details, select_persons,
+                      select_persons_films)
+from elasticsearch import AsyncElasticsearch, helpers
+from es_load import prepare_movie_document
+from logger import logger
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.sql import Select
+from transform import transform_genre, transform_movie, transform_person
+
+# Конец потока: стадия передает его следующей и завершается
+END_OF_STREAM = None
+
+TransformChunk = Callable[[List[Dict]], Awaitable[List[Dict]]]
+
+
+def create_engine() -> AsyncEngine:
+    """Create an asyncpg engine for the configured Postgres DSN."""
+    url = make_url(settings.postgres_dsn).set(drivername="postgresql+asyncpg")
+    return create_async_engine(url, **pool_options())
+
+
+async def extract(engine: AsyncEngine, query: Select, queue: asyncio.Queue):
+    """Stream rows through a server-side cursor into the queue in chunks.
+
+    The queue is bounded, so extraction pauses while later stages lag behind.
+    """
+    async with engine.connect() as connection:
+        result = await connection.stream(
+            query.execution_options(yield_per=settings.batch_size)
+        )
+        async for rows in result.mappings().partitions():
+            await queue.put([dict(row) for row in rows])
+    await queue.put(END_OF_STREAM)
+
+
+async def transform(
+    transform_chunk: TransformChunk, source: asyncio.Queue, target: asyncio.Queue
+):
+    """Transform chunks of rows into documents ready to be indexed."""
+    while (rows := await source.get()) is not END_OF_STREAM:
+        await target.put(await transform_chunk(rows))
+    await target.put(END_OF_STREAM)
+
+
+async def load(es: AsyncElasticsearch, index: str, queue: asyncio.Queue):
+    """Index documents from the queue with streaming bulk requests."""
+
+    async def actions():
+        while (documents := await queue.get()) is not END_OF_STREAM:
+            for document in documents:
+                yield {"_index": index, "_id": document["uuid"], "_source": document}
+
+    success, errors = 0, []
+    async for ok, item in helpers.async_streaming_bulk(
+        es, actions(), chunk_size=settings.es_bulk_chunk_size, raise_on_error=False
+    ):
+        if ok:
+            success += 1
+            continue
+        logger.error(f"Failed to index document in {index}: {item}")
+        errors.append(item)
+
+    logger.info(f"Successfully indexed {success} documents in {index}.")
+    if errors:
+        raise helpers.BulkIndexError(
+            f"{len(errors)} document(s) failed to index in {index}.", errors
+        )
+
+
+async def run_concurrently(*coroutines: Awaitable):
+    """Run coroutines concurrently; once one fails, cancel the others.
+
+    The error is raised only after the cancelled coroutines finished, so the
+    caller may close the clients they were using.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def run_pipeline(
+    engine: AsyncEngine,
+    es: AsyncElasticsearch,
+    query: Select,
+    transform_chunk: TransformChunk,
+    index: str,
+):
+    """Run extract, transform and load stages concurrently for one index.
+
+    Stages are linked by bounded queues: while one chunk is being loaded the
+    next ones are already being extracted and transformed.
+    """
+    rows = asyncio.Queue(maxsize=settings.async_queue_size)
+    documents = asyncio.Queue(maxsize=settings.async_queue_size)
+    await run_concurrently(
+        extract(engine, query, rows),
+        transform(transform_chunk, rows, documents),
+        load(es, index, documents),
+    )
+
+
+def movies_transformer(engine: AsyncEngine) -> TransformChunk:
+    """Build a transform stage enriching movie rows with genres and persons."""
+
+    async def transform_chunk(movie_rows: List[Dict]) -> List[Dict]:
+        movie_ids = [str(movie_row["id"]) for movie_row in movie_rows]
+        genres_query, persons_query = select_movies_details(movie_ids)
+        async with engine.connect() as connection:
+            genre_rows = await connection.execute(genres_query)
+            person_rows = await connection.execute(persons_query)
+        details = collect_movies_details(movie_ids, genre_rows, person_rows)
+        return [
+            prepare_movie_document(
+                transform_movie(movie_row, details[str(movie_row["id"])])
+            )
+            for movie_row in movie_rows
+        ]
+
+    return transform_chunk
+
+
+async def transform_genres(genre_rows: List[Dict]) -> List[Dict]:
+    return [transform_genre(genre_row) for genre_row in genre_rows]
+
+
+def persons_transformer(engine: AsyncEngine) -> TransformChunk:
+    """Build a transform stage enriching person rows with their films."""
+
+    async def transform_chunk(person_rows: List[Dict]) -> List[Dict]:
+        person_ids = [str(person_row["id"]) for person_row in person_rows]
+        async with engine.connect() as connection:
+            film_rows = await connection.execute(select_persons_films(person_ids))
+        films = collect_persons_films(person_ids, film_rows)
+        return [
+            transform_person(person_row, films[str(person_row["id"])])
+            for person_row in person_rows
+        ]
+
+    return transform_chunk
+
+
+async def async_reindex(indexes: Dict[str, str]):
+    """Load the whole catalogue with overlapping extract, transform and load.
+
+    Parameters:
+        indexes: names of the indexes to load, by alias
+    """
+    engine = create_engine()
+    es = AsyncElasticsearch(settings.elasticsearch_dsn)
+    logger.info(f"Starting async reindex with chunk size {settings.batch_size}...")
+    try:
+        await run_concurrently(
+            run_pipeline(
+                engine, es, select_genres(), transform_genres, indexes["genres"]
+            ),
+            run_pipeline(
+                engine,
+                es,
+                select_persons(),
+                persons_transformer(engine),
+                indexes["persons"],
+            ),
+            run_pipeline(
+                engine,
+                es,
+                select_movies(),
+                movies_transformer(engine),
+                indexes[settings.elasticsearch_index],
+            ),
+        )
+    finally:
+        await es.close()
+        await engine.dispose()
+    logger.info("Async reindex finished.")
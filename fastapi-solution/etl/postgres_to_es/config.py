@@ -14,6 +14,21 @@ class Settings(BaseSettings):
     log_level: str = Field("INFO", env="LOG_LEVEL")
     etl_interval_minutes: int = Field(5, env="ETL_INTERVAL_MINUTES")
     backoff_max_time: int = Field(60, env="BACKOFF_MAX_TIME")
+    pg_pool_size: int = Field(5, env="PG_POOL_SIZE")
+    pg_max_overflow: int = Field(5, env="PG_MAX_OVERFLOW")
+    pg_pool_recycle: int = Field(1800, env="PG_POOL_RECYCLE")
+    pg_pool_timeout: int = Field(30, env="PG_POOL_TIMEOUT")
+    es_bulk_chunk_size: int = Field(500, env="ES_BULK_CHUNK_SIZE")
+    es_bulk_thread_count: int = Field(4, env="ES_BULK_THREAD_COUNT")
+    async_queue_size: int = Field(4, env="ASYNC_QUEUE_SIZE")
+    reindex_partitions_per_worker: int = Field(4, env="REINDEX_PARTITIONS_PER_WORKER")
+    es_forcemerge_timeout: int = Field(3600, env="ES_FORCEMERGE_TIMEOUT")
+    cache_invalidation_channel: str = Field(
+        "cache_invalidation", env="CACHE_INVALIDATION_CHANNEL"
+    )
+    listen_channel: str = Field("content_changes", env="LISTEN_CHANNEL")
+    listen_debounce_seconds: float = Field(1.0, env="LISTEN_DEBOUNCE_SECONDS")
+    listen_max_delay_seconds: float = Field(5.0, env="LISTEN_MAX_DELAY_SECONDS")
 
     class Config:
         env_file = ".env"
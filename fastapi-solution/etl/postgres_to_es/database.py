@@ -1,230 +1,494 @@
-from datetime import datetime
-from typing import Dict, List, Optional
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import backoff
 from config import settings
 from logger import logger
-from sqlalchemy import MetaData, Table, create_engine, select
+from sqlalchemy import (Column, Date, DateTime, Float, ForeignKey, MetaData,
+                        String, Table, Text, cast, create_engine, func, select,
+                        tuple_)
+from sqlalchemy.dialects.postgresql import UUID, aggregate_order_by
 from sqlalchemy.exc import DataError, OperationalError
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.sql import Select
+
+from models import Cursor
 
 metadata = MetaData(schema="content")
 
+PERSON_ROLES = ("director", "actor", "writer")
 
-@backoff.on_exception(
-    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+# Таблицы описаны статически по schema_design/dump_db.sql: импорт модуля
+# не обращается к Postgres
+film_work = Table(
+    "film_work",
+    metadata,
+    Column("id", UUID, primary_key=True),
+    Column("title", Text, nullable=False),
+    Column("description", Text),
+    Column("creation_date", Date),
+    Column("rating", Float),
+    Column("type", Text, nullable=False),
+    Column("created", DateTime(timezone=True)),
+    Column("modified", DateTime(timezone=True)),
+)
+person = Table(
+    "person",
+    metadata,
+    Column("id", UUID, primary_key=True),
+    Column("full_name", Text, nullable=False),
+    Column("created", DateTime(timezone=True)),
+    Column("modified", DateTime(timezone=True)),
+)
+person_film_work = Table(
+    "person_film_work",
+    metadata,
+    Column("id", UUID, primary_key=True),
+    Column("film_work_id", UUID, ForeignKey(film_work.c.id), nullable=False),
+    Column("person_id", UUID, ForeignKey(person.c.id), nullable=False),
+    Column("role", Text, nullable=False),
+    Column("created", DateTime(timezone=True)),
+)
+genre = Table(
+    "genre",
+    metadata,
+    Column("id", UUID, primary_key=True),
+    Column("name", Text, nullable=False),
+    Column("description", Text),
+    Column("created", DateTime(timezone=True)),
+    Column("modified", DateTime(timezone=True)),
+)
+genre_film_work = Table(
+    "genre_film_work",
+    metadata,
+    Column("id", UUID, primary_key=True),
+    Column("film_work_id", UUID, ForeignKey(film_work.c.id), nullable=False),
+    Column("genre_id", UUID, ForeignKey(genre.c.id), nullable=False),
+    Column("created", DateTime(timezone=True)),
 )
-def get_session():
-    logger.info("Creating session...")
-    engine = create_engine(settings.postgres_dsn)
-    Session = sessionmaker(bind=engine)
-    return Session()
 
 
-session = get_session()
+def pool_options() -> Dict:
+    """Connection pool options shared by the sync and async engines."""
+    return {
+        "pool_size": settings.pg_pool_size,
+        "max_overflow": settings.pg_max_overflow,
+        "pool_recycle": settings.pg_pool_recycle,
+        "pool_timeout": settings.pg_pool_timeout,
+        "pool_pre_ping": True,
+    }
 
 
-@backoff.on_exception(
-    backoff.expo, OperationalError, max_time=settings.backoff_max_time
-)
-def reflect_metadata(engine):
-    logger.info("Reflecting metadata...")
-    metadata.reflect(bind=engine)
+# Движок подключается лениво, при первом запросе. pool_pre_ping отбрасывает
+# соединения, разорванные при перезапуске или переключении Postgres
+engine = create_engine(settings.postgres_dsn, **pool_options())
 
+# Сессия текущего потока; соединение возвращается в пул в session_scope
+session = scoped_session(sessionmaker(bind=engine))
 
-reflect_metadata(session.bind)
 
-film_work = Table("film_work", metadata, autoload_with=session.bind)
-person = Table("person", metadata, autoload_with=session.bind)
-person_film_work = Table("person_film_work", metadata, autoload_with=session.bind)
-genre = Table("genre", metadata, autoload_with=session.bind)
-genre_film_work = Table("genre_film_work", metadata, autoload_with=session.bind)
+@contextmanager
+def session_scope():
+    """Scope a session to one ETL cycle.
 
+    On exit the session is closed and its connection returns to the pool, so
+    an error in one cycle never leaks a broken connection into the next one.
+    """
+    try:
+        yield session
+    finally:
+        session.remove()
 
-@backoff.on_exception(
-    backoff.expo,
-    (OperationalError, ConnectionError),
-    max_time=settings.backoff_max_time,
-)
-def extract_movies(batch_size: int, last_id: Optional[str]) -> List[Dict]:
-    """Extract movies from the database in batches."""
-    query = select(
-        film_work.c.id,
-        film_work.c.rating,
-        film_work.c.title,
-        film_work.c.description,
-        film_work.c.modified,
-    )
-    if last_id:
-        query = query.where(film_work.c.id > last_id)
-    query = query.order_by(film_work.c.id).limit(batch_size)
+
+def _fetch_all(query) -> List[Dict]:
+    """Execute a query and return its rows as dictionaries."""
     try:
         result = session.execute(query)
         columns = result.keys()
         return [dict(zip(columns, row)) for row in result]
     except DataError as e:
         logger.error(f"DataError: {e}")
+        session.rollback()
         return []
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return []
+    except OperationalError:
+        # Откат освобождает разорванное соединение: повтор возьмет новое из пула
+        session.rollback()
+        raise
+
+
+def _stream(query, chunk_size: int) -> Iterator[List[Dict]]:
+    """Execute a query on a server-side cursor and yield its rows in chunks.
+
+    Only one chunk of rows is held in memory at a time, however large the
+    result set is.
+    """
+    result = session.execute(
+        query.execution_options(stream_results=True, yield_per=chunk_size)
+    )
+    for partition in result.mappings().partitions():
+        yield [dict(row) for row in partition]
+
+
+def _changed_since(query, timestamp_column, id_column, cursor: Cursor, batch_size: int):
+    """Restrict a query to rows after a (timestamp, id) cursor, oldest first."""
+    return (
+        query.where(tuple_(timestamp_column, id_column) > tuple_(*cursor))
+        .order_by(timestamp_column, id_column)
+        .limit(batch_size)
+    )
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (OperationalError, ConnectionError),
+    max_time=settings.backoff_max_time,
+)
+def extract_movies(cursor: Cursor, batch_size: int) -> List[Dict]:
+    """Extract movies modified after the cursor."""
+    query = select(film_work.c.id, film_work.c.modified)
+    return _fetch_all(
+        _changed_since(query, film_work.c.modified, film_work.c.id, cursor, batch_size)
+    )
 
 
 @backoff.on_exception(
     backoff.expo, OperationalError, max_time=settings.backoff_max_time
 )
-def extract_genres(last_modified_genres: datetime) -> List[Dict]:
-    """Extract updated genres from the database."""
-    query = select(genre.c.id, genre.c.name, genre.c.modified).where(
-        genre.c.modified > last_modified_genres
+def extract_genres(cursor: Cursor, batch_size: int) -> List[Dict]:
+    """Extract genres modified after the cursor."""
+    return _fetch_all(
+        _changed_since(
+            select_genres(), genre.c.modified, genre.c.id, cursor, batch_size
+        )
     )
-    try:
-        result = session.execute(query)
-        columns = result.keys()
-        return [dict(zip(columns, row)) for row in result]
-    except DataError as e:
-        logger.error(f"DataError: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return []
 
 
 @backoff.on_exception(
     backoff.expo, OperationalError, max_time=settings.backoff_max_time
 )
-def extract_persons(last_modified_persons: datetime) -> List[Dict]:
-    """Extract updated persons from the database."""
-    query = select(person.c.id, person.c.full_name, person.c.modified).where(
-        person.c.modified > last_modified_persons
+def extract_persons(cursor: Cursor, batch_size: int) -> List[Dict]:
+    """Extract persons modified after the cursor."""
+    return _fetch_all(
+        _changed_since(
+            select_persons(), person.c.modified, person.c.id, cursor, batch_size
+        )
     )
-    try:
-        result = session.execute(query)
-        columns = result.keys()
-        return [dict(zip(columns, row)) for row in result]
-    except DataError as e:
-        logger.error(f"DataError: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return []
 
 
-def get_genres(movie_id: str) -> List[Dict[str, str]]:
-    """Retrieve genres for a given movie."""
-    if not movie_id:
-        logger.error("Invalid movie ID: None")
-        return []
-    query = (
-        select(genre.c.name, genre.c.id)
-        .select_from(
-            genre.join(genre_film_work, genre.c.id == genre_film_work.c.genre_id)
+@backoff.on_exception(
+    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+)
+def extract_genre_links(cursor: Cursor, batch_size: int) -> List[Dict]:
+    """Extract genre to movie links created after the cursor."""
+    query = select(
+        genre_film_work.c.id,
+        genre_film_work.c.film_work_id,
+        genre_film_work.c.created.label("modified"),
+    )
+    return _fetch_all(
+        _changed_since(
+            query,
+            genre_film_work.c.created,
+            genre_film_work.c.id,
+            cursor,
+            batch_size,
         )
-        .where(genre_film_work.c.film_work_id == movie_id)
     )
-    try:
-        result = session.execute(query)
-        return [{"name": row[0], "uuid": str(row[1])} for row in result]
-    except DataError as e:
-        logger.error(f"DataError for movie ID {movie_id}: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error for movie ID {movie_id}: {e}")
-        return []
 
 
-def get_names(movie_id: str, role: str) -> List[str]:
-    """Retrieve names of persons with a given role for a specific movie."""
-    if not movie_id or not role:
-        logger.error("Invalid movie ID or role: movie_id=%s, role=%s", movie_id, role)
-        return []
+@backoff.on_exception(
+    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+)
+def extract_person_links(cursor: Cursor, batch_size: int) -> List[Dict]:
+    """Extract person to movie links created after the cursor."""
+    query = select(
+        person_film_work.c.id,
+        person_film_work.c.film_work_id,
+        person_film_work.c.created.label("modified"),
+    )
+    return _fetch_all(
+        _changed_since(
+            query,
+            person_film_work.c.created,
+            person_film_work.c.id,
+            cursor,
+            batch_size,
+        )
+    )
 
-    query = (
-        select((person.c.full_name))
-        .select_from(person.join(person_film_work))
-        .where(person_film_work.c.film_work_id == movie_id)
-        .where(person_film_work.c.role == role)
+
+def select_movies() -> Select:
+    """Build the query selecting movie rows to be transformed."""
+    return select(
+        film_work.c.id,
+        film_work.c.rating,
+        film_work.c.title,
+        film_work.c.description,
+        film_work.c.modified,
     )
-    try:
-        result = session.execute(query)
-        return [row[0] for row in result]
-    except DataError as e:
-        logger.error(f"DataError for movie ID {movie_id}: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error for movie ID {movie_id}: {e}")
-        return []
 
 
-def get_persons(movie_id: str, role: str) -> List[Dict]:
-    """Retrieve persons with a given role for a specific movie."""
-    query = (
-        select(person.c.id, person.c.full_name)
-        .select_from(person.join(person_film_work))
-        .where(person_film_work.c.film_work_id == movie_id)
-        .where(person_film_work.c.role == role)
+def select_genres() -> Select:
+    """Build the query selecting genre rows to be transformed."""
+    return select(genre.c.id, genre.c.name, genre.c.modified)
+
+
+def select_persons() -> Select:
+    """Build the query selecting person rows to be transformed."""
+    return select(person.c.id, person.c.full_name, person.c.modified)
+
+
+def select_movies_details(movie_ids: List[str]) -> Tuple[Select, Select]:
+    """Build the aggregated genres and persons queries for a batch of movies."""
+    genres_query = (
+        select(
+            genre_film_work.c.film_work_id,
+            func.json_agg(
+                aggregate_order_by(
+                    func.json_build_object(
+                        "uuid", cast(genre.c.id, String), "name", genre.c.name
+                    ),
+                    genre.c.name,
+                )
+            ).label("genres"),
+        )
+        .select_from(
+            genre_film_work.join(genre, genre.c.id == genre_film_work.c.genre_id)
+        )
+        .where(genre_film_work.c.film_work_id.in_(movie_ids))
+        .group_by(genre_film_work.c.film_work_id)
+    )
+    persons_query = (
+        select(
+            person_film_work.c.film_work_id,
+            person_film_work.c.role,
+            func.json_agg(
+                aggregate_order_by(
+                    func.json_build_object(
+                        "id", cast(person.c.id, String), "name", person.c.full_name
+                    ),
+                    person.c.full_name,
+                )
+            ).label("persons"),
+        )
+        .select_from(
+            person_film_work.join(person, person.c.id == person_film_work.c.person_id)
+        )
+        .where(person_film_work.c.film_work_id.in_(movie_ids))
+        .where(person_film_work.c.role.in_(PERSON_ROLES))
+        .group_by(person_film_work.c.film_work_id, person_film_work.c.role)
     )
+    return genres_query, persons_query
+
+
+def collect_movies_details(
+    movie_ids: List[str], genre_rows: Iterable, person_rows: Iterable
+) -> Dict[str, Dict[str, List[Dict]]]:
+    """Group rows of the aggregated details queries by movie ID."""
+    details = {
+        str(movie_id): {role: [] for role in ("genre",) + PERSON_ROLES}
+        for movie_id in movie_ids
+    }
+    for movie_id, genres in genre_rows:
+        details[str(movie_id)]["genre"] = genres
+    for movie_id, role, persons in person_rows:
+        details[str(movie_id)][role] = persons
+    return details
+
 
+@backoff.on_exception(
+    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+)
+def get_movies_details(movie_ids: List[str]) -> Dict[str, Dict[str, List[Dict]]]:
+    """Retrieve genres and persons by role for a batch of movies.
+
+    Two aggregated queries are issued for the whole batch: one for genres
+    and one for persons grouped by film and role. Errors are not swallowed:
+    movies without their details must not be indexed.
+    """
+    if not movie_ids:
+        return {}
+    genres_query, persons_query = select_movies_details(movie_ids)
     try:
-        result = session.execute(query).fetchall()
-        return [{"id": row[0], "name": row[1]} for row in result]
-    except DataError as e:
-        logger.error(f"DataError for movie ID {movie_id}: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error for movie ID {movie_id}: {e}")
-        return []
+        return collect_movies_details(
+            movie_ids, session.execute(genres_query), session.execute(persons_query)
+        )
+    except OperationalError:
+        session.rollback()
+        raise
 
 
-def get_movies_by_genre(genre_ids: List[str]) -> List[Dict]:
-    """Retrieve all movies associated with a list of genre IDs."""
-    if not genre_ids:
-        return []
-    query = (
+def select_persons_films(person_ids: List[str]) -> Select:
+    """Build the query selecting the films of a batch of persons with roles.
+
+    One row is returned per person and film, with all the roles the person
+    had in the film.
+    """
+    return (
         select(
+            person_film_work.c.person_id,
             film_work.c.id,
-            film_work.c.rating,
             film_work.c.title,
-            film_work.c.description,
-            film_work.c.modified,
+            film_work.c.rating,
+            func.array_agg(
+                aggregate_order_by(person_film_work.c.role, person_film_work.c.role)
+            ).label("roles"),
         )
-        .select_from(film_work.join(genre_film_work))
-        .where(genre_film_work.c.genre_id.in_(genre_ids))
+        .select_from(
+            person_film_work.join(
+                film_work, film_work.c.id == person_film_work.c.film_work_id
+            )
+        )
+        .where(person_film_work.c.person_id.in_(person_ids))
+        .where(person_film_work.c.role.in_(PERSON_ROLES))
+        .group_by(person_film_work.c.person_id, film_work.c.id)
+        .order_by(person_film_work.c.person_id, film_work.c.title, film_work.c.id)
     )
+
+
+def collect_persons_films(
+    person_ids: List[str], film_rows: Iterable
+) -> Dict[str, List[Dict]]:
+    """Group rows of the persons films query by person ID."""
+    films = {str(person_id): [] for person_id in person_ids}
+    for person_id, movie_id, title, rating, roles in film_rows:
+        films[str(person_id)].append(
+            {
+                "uuid": str(movie_id),
+                "title": title,
+                "imdb_rating": rating,
+                "roles": roles,
+            }
+        )
+    return films
+
+
+@backoff.on_exception(
+    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+)
+def get_persons_films(person_ids: List[str]) -> Dict[str, List[Dict]]:
+    """Retrieve the films of a batch of persons with their roles in one query.
+
+    Errors are not swallowed: persons without their films must not be indexed.
+    """
+    if not person_ids:
+        return {}
     try:
-        result = session.execute(query)
-        columns = result.keys()
-        return [dict(zip(columns, row)) for row in result]
-    except DataError as e:
-        logger.error(f"DataError: {e}")
+        return collect_persons_films(
+            person_ids, session.execute(select_persons_films(person_ids))
+        )
+    except OperationalError:
+        session.rollback()
+        raise
+
+
+@backoff.on_exception(
+    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+)
+def get_movies_by_ids(movie_ids: List[str]) -> List[Dict]:
+    """Retrieve movie rows for a list of movie IDs."""
+    if not movie_ids:
         return []
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
+    return _fetch_all(select_movies().where(film_work.c.id.in_(movie_ids)))
+
+
+@backoff.on_exception(
+    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+)
+def get_genres_by_ids(genre_ids: List[str]) -> List[Dict]:
+    """Retrieve genre rows for a list of genre IDs."""
+    if not genre_ids:
         return []
+    return _fetch_all(select_genres().where(genre.c.id.in_(genre_ids)))
 
 
-def get_movies_by_person(person_ids: List[str]) -> List[Dict]:
-    """Retrieve all movies associated with a list of person IDs."""
+@backoff.on_exception(
+    backoff.expo, OperationalError, max_time=settings.backoff_max_time
+)
+def get_persons_by_ids(person_ids: List[str]) -> List[Dict]:
+    """Retrieve person rows for a list of person IDs."""
     if not person_ids:
         return []
+    return _fetch_all(select_persons().where(person.c.id.in_(person_ids)))
+
+
+def iter_movie_ids_by_genre(
+    genre_ids: List[str], chunk_size: int
+) -> Iterator[List[str]]:
+    """Stream IDs of all movies associated with a list of genre IDs in chunks."""
+    if not genre_ids:
+        return
     query = (
-        select(
-            film_work.c.id,
-            film_work.c.rating,
-            film_work.c.title,
-            film_work.c.description,
-            film_work.c.modified,
-        )
-        .select_from(film_work.join(person_film_work))
+        select(genre_film_work.c.film_work_id)
+        .where(genre_film_work.c.genre_id.in_(genre_ids))
+        .distinct()
+    )
+    for rows in _stream(query, chunk_size):
+        yield [str(row["film_work_id"]) for row in rows]
+
+
+def iter_movie_ids_by_person(
+    person_ids: List[str], chunk_size: int
+) -> Iterator[List[str]]:
+    """Stream IDs of all movies associated with a list of person IDs in chunks."""
+    if not person_ids:
+        return
+    query = (
+        select(person_film_work.c.film_work_id)
         .where(person_film_work.c.person_id.in_(person_ids))
+        .distinct()
     )
-    try:
-        result = session.execute(query)
-        columns = result.keys()
-        return [dict(zip(columns, row)) for row in result]
-    except DataError as e:
-        logger.error(f"DataError: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return []
+    for rows in _stream(query, chunk_size):
+        yield [str(row["film_work_id"]) for row in rows]
+
+
+def iter_person_ids_by_movie(
+    movie_ids: List[str], chunk_size: int
+) -> Iterator[List[str]]:
+    """Stream IDs of all persons associated with a list of movie IDs in chunks."""
+    if not movie_ids:
+        return
+    query = (
+        select(person_film_work.c.person_id)
+        .where(person_film_work.c.film_work_id.in_(movie_ids))
+        .where(person_film_work.c.role.in_(PERSON_ROLES))
+        .distinct()
+    )
+    for rows in _stream(query, chunk_size):
+        yield [str(row["person_id"]) for row in rows]
+
+
+def iter_movies(chunk_size: int) -> Iterator[List[Dict]]:
+    """Stream all movie rows in chunks for a full reindex."""
+    yield from _stream(select_movies(), chunk_size)
+
+
+def iter_movies_by_id_range(
+    lower: str, upper: Optional[str], chunk_size: int, after: Optional[str] = None
+) -> Iterator[List[Dict]]:
+    """Stream movie rows with lower <= id < upper in chunks, in ID order.
+
+    Parameters:
+        lower: first ID of the range
+        upper: ID following the range, None for the end of the ID space
+        chunk_size: number of rows in a chunk
+        after: resume after this ID instead of starting at lower
+    """
+    query = select_movies().order_by(film_work.c.id)
+    if after:
+        query = query.where(film_work.c.id > after)
+    else:
+        query = query.where(film_work.c.id >= lower)
+    if upper:
+        query = query.where(film_work.c.id < upper)
+    yield from _stream(query, chunk_size)
+
+
+def iter_genres(chunk_size: int) -> Iterator[List[Dict]]:
+    """Stream all genre rows in chunks for a full reindex."""
+    yield from _stream(select_genres(), chunk_size)
+
+
+def iter_persons(chunk_size: int) -> Iterator[List[Dict]]:
+    """Stream all person rows in chunks for a full reindex."""
+    yield from _stream(select_persons(), chunk_size)
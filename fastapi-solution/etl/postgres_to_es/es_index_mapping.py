@@ -1,5 +1,10 @@
+from copy import deepcopy
+from typing import Iterable
+
 from config import settings
 from elasticsearch import Elasticsearch
+from logger import logger
+from utils import clear_document_hashes, publish_changes
 
 # Создаем клиент Elasticsearch с указанием настроек и параметров транспорта
 es = Elasticsearch(settings.elasticsearch_dsn)
@@ -95,7 +100,6 @@ index_body_genres = {
             },
             "name": {
                 "type": "text",
-                "dynamic": "strict",
                 "analyzer": "standard",
                 "fields": {"raw": {"type": "keyword"}},
             },
@@ -115,16 +119,126 @@ index_body_persons = {
             },
             "full_name": {
                 "type": "text",
-                "dynamic": "strict",
                 "analyzer": "standard",
                 "fields": {"raw": {"type": "keyword"}},
             },
-            "modified": {
-                "modified": {"type": "date"},
-            },
+            "modified": {"type": "date"},
+            # Фильмы персоны с ролями: только хранятся, API читает их по id
+            "films": {"type": "object", "enabled": False},
         },
     },
 }
-es.options(ignore_status=[400]).indices.create(index="movies", body=index_body)
-es.options(ignore_status=[400]).indices.create(index="genres", body=index_body_genres)
-es.options(ignore_status=[400]).indices.create(index="persons", body=index_body_persons)
+
+# Индексы доступны API по алиасам, за каждым из которых стоит версия <alias>_v<N>
+INDEXES = {
+    settings.elasticsearch_index: index_body,
+    "genres": index_body_genres,
+    "persons": index_body_persons,
+}
+
+# Настройки новой версии индекса на время массовой загрузки
+BULK_LOAD_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
+
+def next_index_name(alias: str) -> str:
+    """Build the name of the next version of an aliased index."""
+    versions = [
+        int(index.rsplit("_v", 1)[1])
+        for index in es.indices.get(index=f"{alias}_v*")
+        if index.rsplit("_v", 1)[1].isdigit()
+    ]
+    return f"{alias}_v{max(versions, default=0) + 1}"
+
+
+def create_index(alias: str, bulk_load: bool = False) -> str:
+    """Create the next version of an index.
+
+    Parameters:
+        alias: alias the API reads the index by
+        bulk_load: create the index with refresh and replicas disabled and
+            without the alias, to be published later by publish_index
+
+    Returns:
+        name of the created index
+    """
+    index = next_index_name(alias)
+    body = deepcopy(INDEXES[alias])
+    if bulk_load:
+        body["settings"].update(BULK_LOAD_SETTINGS)
+    else:
+        body["aliases"] = {alias: {}}
+    es.indices.create(index=index, body=body)
+    logger.info(f"Created index {index} for alias {alias}")
+    return index
+
+
+def create_indices():
+    """Create the first version of every index that does not exist yet."""
+    for alias in INDEXES:
+        if es.indices.exists(index=alias):
+            logger.info(f"Index {alias} already exists")
+            continue
+        create_index(alias)
+
+
+def live_replicas(alias: str) -> str:
+    """Read the number of replicas of the index currently serving an alias."""
+    if not es.indices.exists(index=alias):
+        return "1"
+    index_settings = es.indices.get_settings(
+        index=alias, name="index.number_of_replicas"
+    )
+    return next(iter(index_settings.values()))["settings"]["index"][
+        "number_of_replicas"
+    ]
+
+
+def publish_index(alias: str, index: str):
+    """Finish a bulk-loaded index and atomically switch its alias to it.
+
+    Live settings are restored, the index is refreshed and force-merged, and
+    the alias is moved in a single update_aliases call. Indexes that served
+    the alias before are deleted afterwards, along with the content hashes
+    the incremental ETL kept for them, and the API is told to drop its cache
+    of the alias.
+    """
+    es.indices.put_settings(
+        index=index,
+        settings={
+            "refresh_interval": INDEXES[alias]["settings"]["refresh_interval"],
+            "number_of_replicas": live_replicas(alias),
+        },
+    )
+    es.indices.refresh(index=index)
+    es.options(request_timeout=settings.es_forcemerge_timeout).indices.forcemerge(
+        index=index, max_num_segments=1
+    )
+
+    actions = [{"add": {"index": index, "alias": alias}}]
+    old_indexes = []
+    if es.indices.exists_alias(name=alias):
+        old_indexes = list(es.indices.get_alias(name=alias))
+        actions[:0] = [
+            {"remove": {"index": old, "alias": alias}} for old in old_indexes
+        ]
+    elif es.indices.exists(index=alias):
+        # Индекс до перехода на алиасы: удаляется той же атомарной операцией
+        actions.insert(0, {"remove_index": {"index": alias}})
+    es.indices.update_aliases(actions=actions)
+    logger.info(f"Alias {alias} now points to {index}")
+    # Хеши и кэш API описывали прежнюю версию индекса
+    clear_document_hashes(alias)
+    publish_changes(alias, None)
+
+    for old_index in old_indexes:
+        es.indices.delete(index=old_index)
+
+
+def drop_indexes(indexes: Iterable[str]):
+    """Delete indexes left over from a failed reindex."""
+    for index in indexes:
+        es.options(ignore_status=[404]).indices.delete(index=index)
+
+
+if __name__ == "__main__":
+    create_indices()
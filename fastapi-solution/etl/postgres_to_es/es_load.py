@@ -1,80 +1,199 @@
-from typing import List
+import hashlib
+import json
+from typing import Dict, Iterable, List, Tuple
 
 from config import settings
 from elasticsearch import Elasticsearch, helpers
 from logger import logger
+from utils import (delete_document_hashes, get_document_hashes,
+                   publish_changes, set_document_hashes)
 
 # Elasticsearch client
 es = Elasticsearch(settings.elasticsearch_dsn)
 
+# Поля, изменение которых само по себе не требует переиндексации документа
+UNHASHED_FIELDS = ("modified",)
+
 
 def transform_person_data(person):
     return {"uuid": str(person["id"]), "full_name": person["name"]}
 
 
-def load_movies_to_elasticsearch(movies: List[dict]):
+def document_hash(document: dict) -> str:
+    """Compute a stable hash of the document content."""
+    content = {
+        field: value
+        for field, value in document.items()
+        if field not in UNHASHED_FIELDS
+    }
+    serialized = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+
+def changed_documents(
+    index: str, documents: List[dict]
+) -> Tuple[List[dict], Dict[str, str]]:
+    """Drop documents whose content did not change since they were last loaded.
+
+    Returns:
+        changed documents and their new hashes by document ID
+    """
+    hashes = {document["uuid"]: document_hash(document) for document in documents}
+    stored_hashes = get_document_hashes(index, list(hashes))
+    changed = {
+        document_id
+        for document_id, stored_hash in zip(hashes, stored_hashes)
+        if hashes[document_id] != stored_hash
+    }
+    skipped = len(hashes) - len(changed)
+    if skipped:
+        logger.info(f"Skipping {skipped} unchanged documents in {index}.")
+    return (
+        [document for document in documents if document["uuid"] in changed],
+        {document_id: hashes[document_id] for document_id in changed},
+    )
+
+
+def bulk_load(index: str, documents: Iterable[dict], skip_unchanged: bool = False):
+    """Load documents to an index with parallel bulk requests.
+
+    Every failed item is logged; if any failed, BulkIndexError is raised
+    after the whole batch was sent so the caller does not commit its state.
+
+    With skip_unchanged, documents are compared to the content hashes stored
+    in Redis and only changed ones are sent; once the whole batch was indexed
+    and made visible to search, the hashes are updated and the IDs of the
+    changed documents are published for the API to drop them from its cache.
+    """
+    hashes = {}
+    if skip_unchanged:
+        documents, hashes = changed_documents(index, list(documents))
+        if not documents:
+            return
+    actions = (
+        {"_index": index, "_id": document["uuid"], "_source": document}
+        for document in documents
+    )
+    success, errors = 0, []
+    for ok, item in helpers.parallel_bulk(
+        es,
+        actions,
+        chunk_size=settings.es_bulk_chunk_size,
+        thread_count=settings.es_bulk_thread_count,
+        raise_on_error=False,
+    ):
+        if ok:
+            success += 1
+            continue
+        logger.error(f"Failed to index document in {index}: {item}")
+        errors.append(item)
+
+    logger.info(f"Successfully indexed {success} documents in {index}.")
+    if errors:
+        raise helpers.BulkIndexError(
+            f"{len(errors)} document(s) failed to index in {index}.", errors
+        )
+    if hashes:
+        # Иначе до ближайшего refresh поиск вернет старые документы, и API
+        # снова закэширует по ним списки и результаты поиска
+        es.indices.refresh(index=index)
+        set_document_hashes(index, hashes)
+        publish_changes(index, list(hashes))
+
+
+def delete_documents(index: str, document_ids: List[str]):
+    """Delete documents removed from Postgres from an index.
+
+    Once the deletion is visible to search, content hashes of the documents
+    are forgotten and their IDs are published for the API to drop them from
+    its cache. Documents already missing from the index are skipped.
+    """
+    if not document_ids:
+        return
+    actions = (
+        {"_op_type": "delete", "_index": index, "_id": document_id}
+        for document_id in document_ids
+    )
+    success, errors = helpers.bulk(es, actions, raise_on_error=False)
+    errors = [item for item in errors if item["delete"]["status"] != 404]
+    logger.info(f"Deleted {success} documents from {index}.")
+    if errors:
+        raise helpers.BulkIndexError(
+            f"{len(errors)} document(s) failed to delete from {index}.", errors
+        )
+    es.indices.refresh(index=index)
+    delete_document_hashes(index, document_ids)
+    publish_changes(index, document_ids)
+
+
+def get_movie_person_ids(
+    movie_ids: List[str], index: str = settings.elasticsearch_index
+) -> List[str]:
+    """Read IDs of the persons of movies from their documents in the index."""
+    if not movie_ids:
+        return []
+    roles = ("directors", "actors", "writers")
+    docs = es.mget(
+        index=index,
+        ids=movie_ids,
+        source_includes=[f"{role}.uuid" for role in roles],
+    )
+    person_ids = {}
+    for doc in docs["docs"]:
+        for role in roles:
+            for person in doc.get("_source", {}).get(role) or []:
+                person_ids[person["uuid"]] = None
+    return list(person_ids)
+
+
+def prepare_movie_document(movie: dict) -> dict:
+    """Convert a transformed movie to the movies index document."""
+    movie_copy = movie.copy()
+
+    # Преобразуем структуру directors, actors и writers
+    if "directors" in movie_copy:
+        movie_copy["directors"] = [
+            transform_person_data(director) for director in movie_copy["directors"]
+        ]
+    if "actors" in movie_copy:
+        movie_copy["actors"] = [
+            transform_person_data(actor) for actor in movie_copy["actors"]
+        ]
+    if "writers" in movie_copy:
+        movie_copy["writers"] = [
+            transform_person_data(writer) for writer in movie_copy["writers"]
+        ]
+    return movie_copy
+
+
+def load_movies_to_elasticsearch(
+    movies: List[dict],
+    index: str = settings.elasticsearch_index,
+    skip_unchanged: bool = True,
+):
     """Load movies to Elasticsearch."""
     if not movies:
         logger.info("No movies to index.")
         return
 
-    actions = []
-    for movie in movies:
-        movie_copy = movie.copy()
-
-        # Преобразуем структуру directors, actors и writers
-        if "directors" in movie_copy:
-            movie_copy["directors"] = [
-                transform_person_data(director) for director in movie_copy["directors"]
-            ]
-        if "actors" in movie_copy:
-            movie_copy["actors"] = [
-                transform_person_data(actor) for actor in movie_copy["actors"]
-            ]
-        if "writers" in movie_copy:
-            movie_copy["writers"] = [
-                transform_person_data(writer) for writer in movie_copy["writers"]
-            ]
-
-        actions.append(
-            {
-                "_index": settings.elasticsearch_index,
-                "_id": movie["uuid"],
-                "_source": movie_copy,
-            }
-        )
-    try:
-        logger.info(
-            f"Indexing actions: {actions}"
-        )  # Логирование данных перед отправкой
-        success, failed = helpers.bulk(es, actions, stats_only=True)
-        logger.info(f"Successfully indexed {success} movies.")
-        if failed:
-            logger.error(f"{failed} movies failed to index.")
-    except helpers.BulkIndexError as e:
-        for error in e.errors:
-            logger.error(f"Failed to index document: {error}")
-        raise
-    except Exception as e:
-        logger.error(f"Failed to index movies in Elasticsearch: {e}")
-        raise
-
-
-def load_genres_to_elasticsearch(genres):
-    es_client = Elasticsearch(settings.elasticsearch_dsn)
-    for genre in genres:
-        try:
-            es_client.index(index="genres", id=genre["uuid"], document=genre)
-            logger.info(f"Genre {genre['uuid']} indexed successfully")
-        except Exception as e:
-            logger.error(f"Failed to index genre {genre['uuid']}: {e}")
-
-
-def load_persons_to_elasticsearch(persons):
-    es_client = Elasticsearch(settings.elasticsearch_dsn)
-    for person in persons:
-        try:
-            es_client.index(index="persons", id=person["uuid"], document=person)
-            logger.info(f"Person {person['uuid']} indexed successfully")
-        except Exception as e:
-            logger.error(f"Failed to index person {person['uuid']}: {e}")
+    bulk_load(
+        index, [prepare_movie_document(movie) for movie in movies], skip_unchanged
+    )
+
+
+def load_genres_to_elasticsearch(
+    genres: List[dict], index: str = "genres", skip_unchanged: bool = True
+):
+    """Load genres to Elasticsearch."""
+    if not genres:
+        return
+    bulk_load(index, genres, skip_unchanged)
+
+
+def load_persons_to_elasticsearch(
+    persons: List[dict], index: str = "persons", skip_unchanged: bool = True
+):
+    """Load persons to Elasticsearch."""
+    if not persons:
+        return
+    bulk_load(index, persons, skip_unchanged)
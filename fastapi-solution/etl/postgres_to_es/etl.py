@@ -1,20 +1,164 @@
-from datetime import datetime
+import argparse
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from uuid import UUID
 
 import backoff
 from apscheduler.schedulers.blocking import BlockingScheduler
+from async_etl import async_reindex
 from config import settings
-from database import (extract_genres, extract_movies, extract_persons,
-                      get_movies_by_genre, get_movies_by_person)
-from es_load import (load_genres_to_elasticsearch,
+from database import (extract_genre_links, extract_genres, extract_movies,
+                      extract_person_links, extract_persons, get_movies_by_ids,
+                      get_persons_by_ids, iter_genres, iter_movie_ids_by_genre,
+                      iter_movie_ids_by_person, iter_movies,
+                      iter_movies_by_id_range, iter_person_ids_by_movie,
+                      iter_persons, session_scope)
+from es_index_mapping import INDEXES, create_index, drop_indexes, publish_index
+from es_load import (delete_documents, get_movie_person_ids,
+                     load_genres_to_elasticsearch,
                      load_movies_to_elasticsearch,
                      load_persons_to_elasticsearch)
 from logger import logger
 from sqlalchemy.exc import OperationalError
-from transform import transform_genre, transform_movie, transform_person
-from utils import (get_last_modified_genres, get_last_modified_movies,
-                   get_last_modified_persons, get_last_processed_id,
-                   set_last_modified_genres, set_last_modified_movies,
-                   set_last_modified_persons, set_last_processed_id)
+from transform import transform_genre, transform_movies, transform_persons
+from utils import (clear_reindex_state, commit_cursors, get_cursors,
+                   get_partition_cursor, get_reindex_state,
+                   set_partition_cursor, set_reindex_state)
+
+from models import Cursor
+
+# Источники изменений: таблица -> функция извлечения строк после курсора
+CHANGE_SOURCES = {
+    "film_work": extract_movies,
+    "genre": extract_genres,
+    "person": extract_persons,
+    "genre_film_work": extract_genre_links,
+    "person_film_work": extract_person_links,
+}
+
+
+def last_cursor(rows: List[Dict]) -> Cursor:
+    """Build the cursor pointing at the last row of an ordered batch."""
+    return rows[-1]["modified"], str(rows[-1]["id"])
+
+
+def load_movies(movie_ids: Iterable[str], loaded_ids: Set[str]) -> List[str]:
+    """Enrich and load changed movies not yet loaded in the current cycle.
+
+    Movies no longer found in Postgres were deleted and are removed from
+    the index.
+
+    Parameters:
+        movie_ids: IDs of changed movies, possibly with duplicates
+        loaded_ids: change set of the cycle, updated with the loaded IDs
+
+    Returns:
+        IDs of the persons the loaded movies had in the index before the load
+    """
+    pending_ids = [
+        movie_id for movie_id in dict.fromkeys(movie_ids) if movie_id not in loaded_ids
+    ]
+    if not pending_ids:
+        return []
+    logger.info(f"Reindexing {len(pending_ids)} changed movies")
+    # Удаленные связи с персонами остались только в документах индекса:
+    # их персоны тоже нужно перезагрузить
+    person_ids = get_movie_person_ids(pending_ids)
+    movie_rows = get_movies_by_ids(pending_ids)
+    load_movies_to_elasticsearch(transform_movies(movie_rows))
+    loaded_ids.update(pending_ids)
+
+    found_ids = {str(movie_row["id"]) for movie_row in movie_rows}
+    deleted_ids = [
+        str(movie_id) for movie_id in pending_ids if str(movie_id) not in found_ids
+    ]
+    if deleted_ids:
+        logger.info(f"Deleting {len(deleted_ids)} movies removed from Postgres")
+        delete_documents(settings.elasticsearch_index, deleted_ids)
+    return person_ids
+
+
+def load_changes(movie_ids: List[str], genre_rows: List[Dict], person_rows: List[Dict]):
+    """Reindex changed genres and persons and every movie affected by changes.
+
+    Persons of the directly changed movies are reindexed as well, since
+    person documents carry the titles and ratings of their films; so are the
+    persons those movies had before the change, whose links may be gone.
+    Movies deleted from Postgres are removed from the index.
+
+    Parameters:
+        movie_ids: IDs of movies changed directly or through link tables
+        genre_rows: changed genre rows
+        person_rows: changed person rows
+    """
+    # Фильмы, уже загруженные в этом цикле: каждый фильм грузится один раз
+    loaded_ids: Set[str] = set()
+    previous_person_ids = load_movies(movie_ids, loaded_ids)
+    changed_movie_ids = list(loaded_ids)
+
+    if genre_rows:
+        genres = [transform_genre(genre_row) for genre_row in genre_rows]
+        load_genres_to_elasticsearch(genres)
+        genre_ids = [genre["id"] for genre in genre_rows]
+        for movie_ids in iter_movie_ids_by_genre(genre_ids, settings.batch_size):
+            load_movies(movie_ids, loaded_ids)
+
+    person_ids = [str(person["id"]) for person in person_rows]
+    if person_ids:
+        for movie_ids in iter_movie_ids_by_person(person_ids, settings.batch_size):
+            load_movies(movie_ids, loaded_ids)
+
+    # Документ персоны хранит названия, рейтинги фильмов и роли в них:
+    # вместе с изменившимися персонами перезагружаются персоны фильмов,
+    # изменившихся напрямую или через связи с персонами, до и после изменения
+    person_ids = dict.fromkeys([*person_ids, *previous_person_ids])
+    for movie_person_ids in iter_person_ids_by_movie(
+        changed_movie_ids, settings.batch_size
+    ):
+        person_ids.update(dict.fromkeys(movie_person_ids))
+    load_persons(list(person_ids))
+
+    logger.info(f"Reindexed {len(loaded_ids)} unique movies in this cycle.")
+
+
+def load_persons(person_ids: List[str]):
+    """Load persons with their films in batches; unchanged ones are skipped."""
+    for start in range(0, len(person_ids), settings.batch_size):
+        person_rows = get_persons_by_ids(
+            person_ids[start:start + settings.batch_size]
+        )
+        load_persons_to_elasticsearch(transform_persons(person_rows))
+
+
+def etl_cycle() -> bool:
+    """Process one batch of changes from every source.
+
+    Returns:
+        True if any source returned a full batch and more changes may be pending.
+    """
+    cursors = get_cursors(CHANGE_SOURCES)
+    with session_scope():
+        changes = {
+            source: extract(cursors[source], settings.batch_size)
+            for source, extract in CHANGE_SOURCES.items()
+        }
+        if not any(changes.values()):
+            logger.info("No data to process.")
+            return False
+
+        movie_ids = [str(row["id"]) for row in changes["film_work"]]
+        for source in ("genre_film_work", "person_film_work"):
+            movie_ids.extend(str(row["film_work_id"]) for row in changes[source])
+        load_changes(movie_ids, changes["genre"], changes["person"])
+
+    # Курсоры фиксируются вместе и только после подтвержденной загрузки
+    commit_cursors(
+        {source: last_cursor(rows) for source, rows in changes.items() if rows}
+    )
+
+    return any(len(rows) == settings.batch_size for rows in changes.values())
 
 
 @backoff.on_exception(
@@ -23,83 +167,200 @@ from utils import (get_last_modified_genres, get_last_modified_movies,
     max_time=settings.backoff_max_time,
 )
 def etl_process():
-    """Main ETL process."""
-    last_id = get_last_processed_id()
-    last_modified_movies = get_last_modified_movies()
-    last_modified_genres = get_last_modified_genres()
-    last_modified_persons = get_last_modified_persons()
-
-    logger.info(
-        f"Starting ETL process with batch size {settings.batch_size}, last processed ID {last_id}, "
-        f"and last modified movies timestamp {last_modified_movies}..."
-    )
+    """Main ETL process: drain all changes accumulated since the last run."""
+    logger.info(f"Starting ETL process with batch size {settings.batch_size}...")
     try:
-        movie_rows = extract_movies(settings.batch_size, last_id)
-        updated_genres = extract_genres(last_modified_genres)
-        updated_persons = extract_persons(last_modified_persons)
+        while etl_cycle():
+            pass
+    except Exception as e:
+        logger.error(f"ETL process failed: {e}")
+        raise
 
-        if not movie_rows and not updated_genres and not updated_persons:
-            logger.info("No data to process.")
-            return
-
-        # Transform movies
-        movies = [transform_movie(movie_row) for movie_row in movie_rows]
-
-        if movie_rows:
-            last_processed_id = movies[-1]["uuid"]
-            set_last_processed_id(last_processed_id)
-            # Update last modified timestamps
-            latest_timestamp_movies = max(
-                [
-                    datetime.fromisoformat(movie["modified"].isoformat())
-                    for movie in movie_rows
-                ]
+
+def partition_bounds(partitions: int) -> List[Tuple[str, Optional[str]]]:
+    """Split the UUID space into equal ranges of movie IDs.
+
+    Returns:
+        (lower, upper) bounds of every range, upper is None for the last one
+    """
+    step = 2**128 // partitions
+    lowers = [str(UUID(int=number * step)) for number in range(partitions)]
+    return list(zip(lowers, lowers[1:] + [None]))
+
+
+def load_movies_partition(
+    index: str, partition: int, lower: str, upper: Optional[str]
+) -> int:
+    """Load one range of movie IDs, run in a worker process of load_catalogue.
+
+    Every worker process has its own Postgres and Elasticsearch connections.
+    The ID of the last loaded movie is checkpointed after every chunk, so a
+    resumed reindex continues the range where it stopped.
+
+    Returns:
+        number of loaded movies
+    """
+    after = get_partition_cursor(index, partition)
+    loaded = 0
+    with session_scope():
+        for movie_rows in iter_movies_by_id_range(
+            lower, upper, settings.batch_size, after
+        ):
+            load_movies_to_elasticsearch(
+                transform_movies(movie_rows), index, skip_unchanged=False
+            )
+            set_partition_cursor(index, partition, str(movie_rows[-1]["id"]))
+            loaded += len(movie_rows)
+    logger.info(f"Loaded {loaded} movies of partition {partition} to {index}")
+    return loaded
+
+
+def load_genres_and_persons(indexes: Dict[str, str]):
+    """Stream all genres and persons into the given indexes."""
+    with session_scope():
+        for genre_rows in iter_genres(settings.batch_size):
+            load_genres_to_elasticsearch(
+                [transform_genre(row) for row in genre_rows],
+                indexes["genres"],
+                skip_unchanged=False,
             )
-            set_last_modified_movies(latest_timestamp_movies)
-
-        if updated_genres:
-            # Transform genres
-            genres = [transform_genre(genre_row) for genre_row in updated_genres]
-            # Load genres to Elasticsearch
-            load_genres_to_elasticsearch(genres)
-            # Update last modified timestamp for genres
-            latest_timestamp_genres = max(genre["modified"] for genre in updated_genres)
-            set_last_modified_genres(latest_timestamp_genres)
-            # Get and transform movies by updated genres
-            genre_ids = [genre["id"] for genre in updated_genres]
-            genre_movie_rows = get_movies_by_genre(genre_ids)
-            genre_movies = [
-                transform_movie(movie_row) for movie_row in genre_movie_rows
-            ]
-            movies.extend(genre_movies)
-
-        if updated_persons:
-            # Transform persons
-            persons = [transform_person(person_row) for person_row in updated_persons]
-            # Load persons to Elasticsearch
-            load_persons_to_elasticsearch(persons)
-            # Update last modified timestamp for persons
-            latest_timestamp_persons = max(
-                [person["modified"] for person in updated_persons]
+        for person_rows in iter_persons(settings.batch_size):
+            load_persons_to_elasticsearch(
+                transform_persons(person_rows),
+                indexes["persons"],
+                skip_unchanged=False,
             )
-            set_last_modified_persons(latest_timestamp_persons)
 
-            person_ids = [person["id"] for person in updated_persons]
-            person_movie_rows = get_movies_by_person(person_ids)
-            person_movies = [
-                transform_movie(movie_row) for movie_row in person_movie_rows
-            ]
-            movies.extend(person_movies)
 
-        # Load movies to Elasticsearch
-        load_movies_to_elasticsearch(movies)
+def load_catalogue(indexes: Dict[str, str], workers: int = 0, partitions: int = 0):
+    """Stream the whole catalogue into the given indexes in fixed-size chunks.
 
-    except Exception as e:
-        logger.error(f"ETL process failed: {e}")
+    Every document is sent: the indexes are new and content hashes stored for
+    the live ones do not describe them.
+
+    Parameters:
+        indexes: names of the indexes to load, by alias
+        workers: number of processes loading ranges of movie IDs in parallel,
+            0 to load movies in this process
+        partitions: number of ranges of movie IDs the workers share
+    """
+    movies_index = indexes[settings.elasticsearch_index]
+    if not workers:
+        load_genres_and_persons(indexes)
+        with session_scope():
+            for movie_rows in iter_movies(settings.batch_size):
+                load_movies_to_elasticsearch(
+                    transform_movies(movie_rows), movies_index, skip_unchanged=False
+                )
+        return
+
+    # spawn: процессы не наследуют соединения родителя и открывают свои
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(workers, mp_context=context)
+    try:
+        futures = [
+            executor.submit(load_movies_partition, movies_index, number, lower, upper)
+            for number, (lower, upper) in enumerate(partition_bounds(partitions))
+        ]
+        load_genres_and_persons(indexes)
+        loaded = sum(future.result() for future in as_completed(futures))
+    except BaseException:
+        executor.shutdown(cancel_futures=True)
         raise
+    executor.shutdown()
+    logger.info(f"Loaded {loaded} movies with {workers} workers")
 
 
-if __name__ == "__main__":
+def reindex(use_async: bool = False, workers: int = 0, resume: bool = False):
+    """Rebuild all indexes without downtime.
+
+    The catalogue is loaded into new index versions with refresh and replicas
+    disabled, then every alias is switched to its new version. The API keeps
+    reading the old versions until the switch. Changes written by the
+    incremental ETL while the rebuild runs go to the old versions: once the
+    aliases are switched, its cursors are rewound to where they were when
+    the rebuild started, and the next cycle replays those changes onto the
+    new versions.
+
+    A parallel reindex that failed keeps its new index versions and partition
+    checkpoints; with resume it continues loading them instead of starting
+    over.
+    """
+    logger.info(f"Starting full reindex with chunk size {settings.batch_size}...")
+    state = get_reindex_state()
+    if state and not resume:
+        logger.info("Dropping indexes of an unfinished reindex")
+        drop_indexes(state["indexes"].values())
+        clear_reindex_state(state["indexes"][settings.elasticsearch_index])
+        state = None
+    if not state:
+        state = {
+            # Снимок курсоров до загрузки: изменения, прочитанные после него,
+            # могли попасть только в старые версии индексов
+            "cursors": get_cursors(CHANGE_SOURCES),
+            "indexes": {
+                alias: create_index(alias, bulk_load=True) for alias in INDEXES
+            },
+            "partitions": workers * settings.reindex_partitions_per_worker,
+        }
+        if workers:
+            set_reindex_state(state)
+    else:
+        logger.info(f"Resuming reindex into {list(state['indexes'].values())}")
+    indexes = state["indexes"]
+    movies_index = indexes[settings.elasticsearch_index]
+
+    try:
+        if workers:
+            load_catalogue(indexes, workers, state["partitions"])
+        elif use_async:
+            asyncio.run(async_reindex(indexes))
+        else:
+            load_catalogue(indexes)
+    except Exception:
+        if workers:
+            logger.error("Reindex failed, run it with --resume to continue")
+        else:
+            drop_indexes(indexes.values())
+        raise
+    for alias, index in indexes.items():
+        publish_index(alias, index)
+    commit_cursors(state.get("cursors", {}))
+    clear_reindex_state(movies_index)
+    logger.info("Full reindex finished.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Postgres to Elasticsearch ETL")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="run incremental ETL on a schedule (default)")
+    reindex_parser = commands.add_parser(
+        "reindex", help="rebuild all indexes and switch aliases to them"
+    )
+    reindex_mode = reindex_parser.add_mutually_exclusive_group()
+    reindex_mode.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="overlap extract, transform and load with asyncio",
+    )
+    reindex_mode.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="load ranges of movie IDs in N parallel processes",
+    )
+    reindex_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue a failed parallel reindex from its checkpoints",
+    )
+    args = parser.parse_args()
+
+    if args.command == "reindex":
+        reindex(args.use_async, args.workers, args.resume)
+        return
+
     scheduler = BlockingScheduler()
     scheduler.add_job(etl_process, "interval", minutes=settings.etl_interval_minutes)
     try:
@@ -107,3 +368,7 @@ if __name__ == "__main__":
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         pass
+
+
+if __name__ == "__main__":
+    main()
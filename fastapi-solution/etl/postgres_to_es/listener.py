@@ -0,0 +1,156 @@
+import json
+import select
+import time
+from typing import Dict, Iterable, List, Set
+
+import backoff
+import psycopg2
+from config import settings
+from database import get_genres_by_ids, get_persons_by_ids, session_scope
+from es_load import delete_documents
+from logger import logger
+from sqlalchemy.engine import make_url
+
+from etl import etl_process, load_changes
+
+# Таблицы, изменение которых напрямую затрагивает документ фильма
+# и поле уведомления с id фильма
+MOVIE_TABLES = {
+    "film_work": "id",
+    "genre_film_work": "film_work_id",
+    "person_film_work": "film_work_id",
+}
+
+
+def missing_ids(notified_ids: Iterable[str], rows: List[Dict]) -> List[str]:
+    """IDs from notifications whose rows are no longer found in Postgres."""
+    found_ids = {str(row["id"]) for row in rows}
+    return [row_id for row_id in notified_ids if row_id not in found_ids]
+
+
+class PendingChanges:
+    """IDs collected from notifications and not yet loaded to Elasticsearch."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget all collected IDs."""
+        self.movie_ids: Dict[str, None] = {}
+        self.genre_ids: Set[str] = set()
+        self.person_ids: Set[str] = set()
+        self.first_seen: float = 0.0
+        self.last_seen: float = 0.0
+
+    def __len__(self) -> int:
+        return len(self.movie_ids) + len(self.genre_ids) + len(self.person_ids)
+
+    def add(self, payload: str):
+        """Register the row referenced by a content_changes notification."""
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            logger.error(f"Malformed notification payload: {payload}")
+            return
+        table = change.get("table")
+        if table in MOVIE_TABLES:
+            self.movie_ids[change[MOVIE_TABLES[table]]] = None
+        elif table == "genre":
+            self.genre_ids.add(change["id"])
+        elif table == "person":
+            self.person_ids.add(change["id"])
+        else:
+            return
+
+        now = time.monotonic()
+        if not self.first_seen:
+            self.first_seen = now
+        self.last_seen = now
+
+    def is_ready(self) -> bool:
+        """Check whether the micro-batch should be flushed.
+
+        A batch is flushed once notifications stop arriving for the debounce
+        window, once the oldest change waited for the maximum delay, or once
+        the batch is full.
+        """
+        if not self:
+            return False
+        now = time.monotonic()
+        return (
+            now - self.last_seen >= settings.listen_debounce_seconds
+            or now - self.first_seen >= settings.listen_max_delay_seconds
+            or len(self) >= settings.batch_size
+        )
+
+    def flush(self):
+        """Load pending changes to Elasticsearch and reset the batch."""
+        logger.info(
+            f"Loading notified changes: {len(self.movie_ids)} movies, "
+            f"{len(self.genre_ids)} genres, {len(self.person_ids)} persons"
+        )
+        with session_scope():
+            genre_rows = get_genres_by_ids(list(self.genre_ids))
+            person_rows = get_persons_by_ids(list(self.person_ids))
+            # Удаленные фильмы убирает из индекса load_changes
+            load_changes(list(self.movie_ids), genre_rows, person_rows)
+            # Удаленные жанры и персоны уведомили о себе, но строк у них уже нет
+            delete_documents("genres", missing_ids(self.genre_ids, genre_rows))
+            delete_documents("persons", missing_ids(self.person_ids, person_rows))
+        self.reset()
+
+
+def connect():
+    """Open a dedicated autocommit connection listening for content changes."""
+    url = make_url(settings.postgres_dsn).set(drivername="postgresql")
+    connection = psycopg2.connect(url.render_as_string(hide_password=False))
+    connection.set_session(autocommit=True)
+    with connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {settings.listen_channel};")
+    logger.info(f"Listening for notifications on {settings.listen_channel}...")
+    return connection
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (psycopg2.OperationalError, ConnectionError),
+    max_time=settings.backoff_max_time,
+)
+def listen():
+    """Load changes to Elasticsearch as soon as Postgres notifies about them.
+
+    Notifications are debounced into micro-batches. Polling with etl_process
+    runs on start and then every etl_interval_minutes only to catch up on
+    changes missed while the listener was down.
+    """
+    connection = connect()
+    pending = PendingChanges()
+    catch_up_interval = settings.etl_interval_minutes * 60
+    next_catch_up = 0.0
+    try:
+        while True:
+            if time.monotonic() >= next_catch_up:
+                etl_process()
+                next_catch_up = time.monotonic() + catch_up_interval
+
+            if pending:
+                timeout = settings.listen_debounce_seconds
+            else:
+                timeout = max(next_catch_up - time.monotonic(), 0)
+            readable, _, _ = select.select([connection], [], [], timeout)
+            if readable:
+                connection.poll()
+                while connection.notifies:
+                    pending.add(connection.notifies.pop(0).payload)
+
+            if pending.is_ready():
+                pending.flush()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    try:
+        listen()
+    except (KeyboardInterrupt, SystemExit):
+        pass
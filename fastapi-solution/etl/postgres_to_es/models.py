@@ -1,7 +1,11 @@
-from typing import Dict, List, Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 from pydantic import BaseModel
 
+# Позиция в потоке изменений таблицы: (modified, id) последней обработанной строки
+Cursor = Tuple[datetime, str]
+
 
 class Genre(BaseModel):
     uuid: str
@@ -1,15 +1,26 @@
 import logging
-from typing import Dict
+from typing import Dict, List
 
-from database import get_genres, get_names, get_persons
+from database import get_movies_details, get_persons_films
 
 from models import Movie
 
 logger = logging.getLogger(__name__)
 
 
-def transform_movie(movie_row: Dict) -> Dict:
-    """Transform a database row to a dictionary for Elasticsearch."""
+def transform_movies(movie_rows: List[Dict]) -> List[Dict]:
+    """Transform a batch of database rows to dictionaries for Elasticsearch."""
+    if not movie_rows:
+        return []
+    details = get_movies_details([str(movie_row["id"]) for movie_row in movie_rows])
+    return [
+        transform_movie(movie_row, details.get(str(movie_row["id"]), {}))
+        for movie_row in movie_rows
+    ]
+
+
+def transform_movie(movie_row: Dict, movie_details: Dict[str, List[Dict]]) -> Dict:
+    """Transform a database row and its preloaded details for Elasticsearch."""
     movie_id = str(movie_row["id"])
     description = movie_row.get("description", "") or ""
     imdb_rating = movie_row.get("rating")
@@ -17,28 +28,19 @@ def transform_movie(movie_row: Dict) -> Dict:
     if not description:
         description = ""
 
-    try:
-        genres = get_genres(movie_id)
-        directors_names = get_names(movie_id, "director")
-        actors_names = get_names(movie_id, "actor")
-        writers_names = get_names(movie_id, "writer")
-        directors = get_persons(movie_id, "director")
-        actors = get_persons(movie_id, "actor")
-        writers = get_persons(movie_id, "writer")
-    except Exception as e:
-        logger.error(f"Error retrieving genres for movie ID: {movie_id}: {e}")
-        genres = directors_names = actors_names = writers_names = []
-        directors = actors = writers = []
+    directors = movie_details.get("director", [])
+    actors = movie_details.get("actor", [])
+    writers = movie_details.get("writer", [])
 
     movie = Movie(
         uuid=movie_id,
         imdb_rating=imdb_rating if imdb_rating is not None else None,
-        genre=genres,
+        genre=movie_details.get("genre", []),
         title=movie_row["title"],
         description=description,
-        directors_names=directors_names,
-        actors_names=actors_names,
-        writers_names=writers_names,
+        directors_names=[director["name"] for director in directors],
+        actors_names=[actor["name"] for actor in actors],
+        writers_names=[writer["name"] for writer in writers],
         directors=directors,
         actors=actors,
         writers=writers,
@@ -53,9 +55,21 @@ def transform_genre(genre_row):
     }
 
 
-def transform_person(person_row):
+def transform_persons(person_rows: List[Dict]) -> List[Dict]:
+    """Transform a batch of person rows together with the films of the persons."""
+    if not person_rows:
+        return []
+    films = get_persons_films([str(person_row["id"]) for person_row in person_rows])
+    return [
+        transform_person(person_row, films.get(str(person_row["id"]), []))
+        for person_row in person_rows
+    ]
+
+
+def transform_person(person_row, films: List[Dict]):
     return {
         "uuid": str(person_row["id"]),
         "full_name": person_row["full_name"],
         "modified": person_row["modified"],
+        "films": films,
     }
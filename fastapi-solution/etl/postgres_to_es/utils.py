@@ -1,63 +1,141 @@
+import json
+import uuid
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Iterable, List, Optional
 
 from config import settings
 from redis import Redis
 
+from models import Cursor
+
 redis_client = Redis.from_url(settings.redis_dsn)
 
+INITIAL_CURSOR: Cursor = (datetime.min, "00000000-0000-0000-0000-000000000000")
 
-def get_last_processed_id() -> Optional[str]:
-    """Retrieve the last processed movie ID from Redis."""
-    last_id = redis_client.get("last_processed_id")
-    return last_id.decode("utf-8") if last_id else None
 
+# Курсоры всех источников хранятся в одном хеше и фиксируются одной командой
+CHECKPOINT_KEY = "checkpoint:etl"
 
-def set_last_processed_id(movie_id: str):
-    """Store the last processed movie ID in Redis."""
-    redis_client.set("last_processed_id", str(movie_id))
 
+def _decode_cursor(value: bytes) -> Cursor:
+    data = json.loads(value)
+    return datetime.fromisoformat(data["modified"]), data["id"]
 
-def get_last_modified_movies() -> datetime:
-    """Retrieve the last modified timestamp of movies from Redis."""
-    last_modified = redis_client.get("last_modified_movies")
-    return (
-        datetime.fromisoformat(last_modified.decode("utf-8"))
-        if last_modified
-        else datetime.min
-    )
+
+def _encode_cursor(cursor: Cursor) -> str:
+    modified, row_id = cursor
+    return json.dumps({"modified": modified.isoformat(), "id": str(row_id)})
 
 
-def set_last_modified_movies(last_modified: datetime):
-    """Store the last modified timestamp of movies in Redis."""
-    redis_client.set("last_modified_movies", last_modified.isoformat())
+def get_cursors(sources: Iterable[str]) -> Dict[str, Cursor]:
+    """Retrieve the (modified, id) cursors of change sources from Redis.
 
+    Cursors stored by earlier versions under separate cursor:<source> keys
+    are picked up until the first commit_cursors call replaces them.
+    """
+    sources = list(sources)
+    cursors = {}
+    for source, value in zip(sources, redis_client.hmget(CHECKPOINT_KEY, sources)):
+        value = value or redis_client.get(f"cursor:{source}")
+        cursors[source] = _decode_cursor(value) if value else INITIAL_CURSOR
+    return cursors
 
-def get_last_modified_genres() -> datetime:
-    """Retrieve the last modified timestamp of genres from Redis."""
-    last_modified = redis_client.get("last_modified_genres")
-    return (
-        datetime.fromisoformat(last_modified.decode("utf-8"))
-        if last_modified
-        else datetime.min
+
+def commit_cursors(cursors: Dict[str, Cursor]):
+    """Atomically store the cursors of all sources advanced in a cycle.
+
+    Must be called only after everything read before the cursors was loaded
+    to Elasticsearch: a crash then costs at most a rerun of the last cycle.
+    """
+    if not cursors:
+        return
+    pipeline = redis_client.pipeline(transaction=True)
+    pipeline.hset(
+        CHECKPOINT_KEY,
+        mapping={source: _encode_cursor(cursor) for source, cursor in cursors.items()},
     )
+    pipeline.delete(*(f"cursor:{source}" for source in cursors))
+    pipeline.execute()
 
 
-def set_last_modified_genres(last_modified: datetime):
-    """Store the last modified timestamp of genres in Redis."""
-    redis_client.set("last_modified_genres", last_modified.isoformat())
+def get_document_hashes(index: str, document_ids: List[str]) -> List[Optional[str]]:
+    """Retrieve content hashes of the documents last loaded to an index."""
+    if not document_ids:
+        return []
+    return [
+        document_hash.decode() if document_hash else None
+        for document_hash in redis_client.hmget(f"doc_hashes:{index}", document_ids)
+    ]
 
 
-def get_last_modified_persons() -> datetime:
-    """Retrieve the last modified timestamp of persons from Redis."""
-    last_modified = redis_client.get("last_modified_persons")
-    return (
-        datetime.fromisoformat(last_modified.decode("utf-8"))
-        if last_modified
-        else datetime.min
-    )
+def set_document_hashes(index: str, hashes: Dict[str, str]):
+    """Store content hashes of the documents loaded to an index."""
+    if hashes:
+        redis_client.hset(f"doc_hashes:{index}", mapping=hashes)
+
+
+def delete_document_hashes(index: str, document_ids: List[str]):
+    """Forget content hashes of documents deleted from an index."""
+    if document_ids:
+        redis_client.hdel(f"doc_hashes:{index}", *document_ids)
+
+
+def clear_document_hashes(index: str):
+    """Forget all content hashes of an index, e.g. after it was rebuilt."""
+    redis_client.delete(f"doc_hashes:{index}")
+
+
+def get_reindex_state() -> Optional[Dict]:
+    """Retrieve indexes, partitioning and cursors of an unfinished parallel reindex."""
+    state = redis_client.get("reindex:state")
+    if not state:
+        return None
+    state = json.loads(state)
+    state["cursors"] = {
+        source: _decode_cursor(cursor)
+        for source, cursor in state.get("cursors", {}).items()
+    }
+    return state
 
 
-def set_last_modified_persons(last_modified: datetime):
-    """Store the last modified timestamp of persons in Redis."""
-    redis_client.set("last_modified_persons", last_modified.isoformat())
+def set_reindex_state(state: Dict):
+    """Store indexes, partitioning and cursors of a parallel reindex being run."""
+    cursors = {
+        source: _encode_cursor(cursor)
+        for source, cursor in state.get("cursors", {}).items()
+    }
+    redis_client.set("reindex:state", json.dumps({**state, "cursors": cursors}))
+
+
+def clear_reindex_state(index: str):
+    """Forget a finished or abandoned reindex and its partition cursors."""
+    redis_client.delete("reindex:state", f"checkpoint:reindex:{index}")
+
+
+def get_partition_cursor(index: str, partition: int) -> Optional[str]:
+    """Retrieve the ID of the last movie of a partition loaded to an index."""
+    movie_id = redis_client.hget(f"checkpoint:reindex:{index}", partition)
+    return movie_id.decode() if movie_id else None
+
+
+def set_partition_cursor(index: str, partition: int, movie_id: str):
+    """Store the ID of the last movie of a partition loaded to an index."""
+    redis_client.hset(f"checkpoint:reindex:{index}", partition, movie_id)
+
+
+def publish_changes(index: str, document_ids: Optional[List[str]]):
+    """Tell the API which documents of an index changed so it drops their cache.
+
+    Parameters:
+        index: alias of the changed index
+        document_ids: IDs of changed documents, None if the whole index changed
+
+    Every API worker clears its local cache, while the shared Redis cache is
+    cleared by the single worker that claims the message ID first.
+    """
+    redis_client.publish(
+        settings.cache_invalidation_channel,
+        json.dumps(
+            {"index": index, "ids": document_ids, "message_id": uuid.uuid4().hex}
+        ),
+    )
@@ -48,19 +48,12 @@ CREATE INDEX film_work_creation_date_idx ON film_work(creation_date);
 CREATE INDEX person_full_name_idx ON person(full_name);
 CREATE UNIQUE INDEX film_work_genre_idx ON genre_film_work (film_work_id, genre_id);
 CREATE UNIQUE INDEX film_work_person_role_idx ON person_film_work (film_work_id, person_id, role);
-
--- CREATE OR REPLACE FUNCTION notify_genre_changes()
--- RETURNS trigger AS $$
--- BEGIN
---   PERFORM pg_notify('genre_changes', row_to_json(NEW)::text);
---   RETURN NEW;
--- END;
--- $$ LANGUAGE plpgsql;
-
--- CREATE TRIGGER genre_changes_trigger
--- AFTER INSERT OR UPDATE OR DELETE ON genre
--- FOR EACH ROW EXECUTE FUNCTION notify_genre_changes();
-
+-- Выборки изменений ETL по курсору (modified, id) / (created, id) идут по индексу без сортировки
+CREATE INDEX IF NOT EXISTS film_work_modified_id_idx ON film_work (modified, id);
+CREATE INDEX IF NOT EXISTS genre_modified_id_idx ON genre (modified, id);
+CREATE INDEX IF NOT EXISTS person_modified_id_idx ON person (modified, id);
+CREATE INDEX IF NOT EXISTS genre_film_work_created_id_idx ON genre_film_work (created, id);
+CREATE INDEX IF NOT EXISTS person_film_work_created_id_idx ON person_film_work (created, id);
 
 COPY content.film_work (id, title, description, creation_date, rating, type, created, modified) FROM stdin;
 3d825f60-9fff-4dfe-b294-1a45fa1e115d	Star Wars: Episode IV - A New Hope	The Imperial Forces, under orders from cruel Darth Vader, hold Princess Leia hostage in their efforts to quell the rebellion against the Galactic Empire. Luke Skywalker and Han Solo, captain of the Millennium Falcon, work together with the companionable droid duo R2-D2 and C-3PO to rescue the beautiful princess, help the Rebel Alliance and restore freedom and justice to the Galaxy.	\N	8.6	movie	2024-06-12 15:09:56.46696+00	2024-06-12 15:09:56.466963+00
@@ -13301,3 +13294,49 @@ c789099a-d49f-4895-b250-bc8064094073	17bc0cc6-6d9d-4a7c-81b3-4556e1d3ac04	7f09d6
 f67bbd77-67a4-4872-a343-40b97497c006	2dd036a4-f5d0-4e81-8073-a36da2a684b7	0f5df313-bfe5-450b-942c-3844214b7c41	actor	2024-06-12 15:10:01.034608+00
 73d0f092-06ed-48d5-bb02-8da8933fbfe2	83af8d01-580a-462e-8c96-2171385935cc	97568425-6959-4b86-b81d-d3198eabfdac	writer	2024-06-12 15:10:01.034611+00
 \.
+
+
+-- Уведомления ETL об изменениях: канал content_changes, payload -
+-- {"table": ..., "id": ..., "film_work_id": ...} (film_work_id есть у таблиц связей).
+-- Триггеры создаются после загрузки данных, чтобы не слать уведомления на COPY.
+CREATE OR REPLACE FUNCTION content.notify_content_changes()
+RETURNS trigger AS $$
+DECLARE
+  changed jsonb;
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    changed := to_jsonb(OLD);
+  ELSE
+    changed := to_jsonb(NEW);
+  END IF;
+  PERFORM pg_notify(
+    'content_changes',
+    json_build_object(
+      'table', TG_TABLE_NAME,
+      'id', changed->>'id',
+      'film_work_id', changed->>'film_work_id'
+    )::text
+  );
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER film_work_changes_trigger
+AFTER INSERT OR UPDATE OR DELETE ON content.film_work
+FOR EACH ROW EXECUTE FUNCTION content.notify_content_changes();
+
+CREATE OR REPLACE TRIGGER genre_changes_trigger
+AFTER INSERT OR UPDATE OR DELETE ON content.genre
+FOR EACH ROW EXECUTE FUNCTION content.notify_content_changes();
+
+CREATE OR REPLACE TRIGGER person_changes_trigger
+AFTER INSERT OR UPDATE OR DELETE ON content.person
+FOR EACH ROW EXECUTE FUNCTION content.notify_content_changes();
+
+CREATE OR REPLACE TRIGGER genre_film_work_changes_trigger
+AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+FOR EACH ROW EXECUTE FUNCTION content.notify_content_changes();
+
+CREATE OR REPLACE TRIGGER person_film_work_changes_trigger
+AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+FOR EACH ROW EXECUTE FUNCTION content.notify_content_changes();
@@ -1,9 +1,12 @@
 from http import HTTPStatus
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 
+from models.batch import BatchRequest
 from models.film import Film, FilmDetailed
+from models.page import CursorPage
 from services.film import (FilmService, MultipleFilmsService, get_film_service,
                            get_multiple_films_service)
 
@@ -70,6 +73,42 @@ async def get_popular_films(
     )
 
 
+@router.get(
+    "/scroll",
+    response_model=CursorPage[Film],
+    summary="Популярные фильмы по курсору",
+    description=(
+        "То же, что и список популярных фильмов, "
+        "но страницы листаются курсором next_cursor из предыдущего ответа"
+    ),
+)
+async def scroll_popular_films(
+    similar: Optional[str] = Query(
+        None, description="Get films of same genre as similar"
+    ),
+    genre: Optional[str] = Query(None, description="Get films of given genres"),
+    sort: str = Query("-imdb_rating", description="Sort by field"),
+    page_size: int = Query(50, description="Number of items per page", ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor of previous page"),
+    film_service: MultipleFilmsService = Depends(get_multiple_films_service),
+) -> CursorPage[Film]:
+    valid_sort_fields = ("imdb_rating", "-imdb_rating")
+    if sort not in valid_sort_fields:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail='Invalid value for "sort" parameter',
+        )
+
+    films, next_cursor = await film_service.get_multiple_films_by_cursor(
+        similar=similar,
+        genre=genre,
+        desc_order=sort[0] == "-",
+        page_size=page_size,
+        cursor=cursor,
+    )
+    return CursorPage(items=films, next_cursor=next_cursor)
+
+
 # 3. Поиск по фильмам (2.1. из т.з.)
 # GET /api/v1/films/search?query=star&page_number=1&page_size=50
 
@@ -94,6 +133,60 @@ async def fulltext_search_filmworks(
     )
 
 
+@router.get(
+    "/search/scroll",
+    response_model=CursorPage[Film],
+    summary="Поиск фильма по наименованию с выдачей по курсору",
+    description="Страницы листаются курсором next_cursor из предыдущего ответа",
+)
+async def scroll_fulltext_search_filmworks(
+    query: str = Query("Star", description="Film title or part of film title"),
+    page_size: int = Query(50, description="Number of items per page", ge=1),
+    cursor: Optional[str] = Query(None, description="next_cursor of previous page"),
+    pop_film_service: MultipleFilmsService = Depends(get_multiple_films_service),
+) -> CursorPage[Film]:
+    films, next_cursor = await pop_film_service.search_films_by_cursor(
+        query, page_size, cursor
+    )
+    return CursorPage(items=films, next_cursor=next_cursor)
+
+
+@router.get(
+    "/export",
+    response_class=StreamingResponse,
+    summary="Выгрузка каталога фильмов",
+    description="Все фильмы в формате NDJSON, по одному в строке; поля фильма можно выбрать параметром fields",
+)
+async def export_films(
+    fields: Optional[List[str]] = Query(None, description="Film fields to export"),
+    film_service: MultipleFilmsService = Depends(get_multiple_films_service),
+) -> StreamingResponse:
+    if fields:
+        unknown = set(fields) - set(FilmDetailed.model_fields)
+        if unknown:
+            raise HTTPException(
+                status_code=HTTPStatus.BAD_REQUEST,
+                detail=f'Invalid value for "fields" parameter: {", ".join(sorted(unknown))}',
+            )
+
+    return StreamingResponse(
+        await film_service.export_films(fields), media_type="application/x-ndjson"
+    )
+
+
+@router.post(
+    "/batch",
+    response_model=list[FilmDetailed],
+    summary="Запрос нескольких фильмов по id",
+    description="Полная информация о фильмах из списка id; ненайденные фильмы пропускаются",
+)
+async def films_batch(
+    batch: BatchRequest,
+    film_service: FilmService = Depends(get_film_service),
+) -> list[FilmDetailed]:
+    return await film_service.get_by_uuids(batch.ids)
+
+
 # 4. Полная информация по фильму (т.з. 3.1.)
 
 
@@ -1,14 +1,46 @@
 from http import HTTPStatus
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 
+from models.batch import BatchRequest
 from models.genre import Genre, GenrePaginationResponse
+from models.page import CursorPage
 from services.genre import GenreService, get_genre_service
 
 router = APIRouter()
 
 
+@router.post(
+    "/batch", response_model=List[Genre], summary="Запрос нескольких жанров по id"
+)
+async def genres_batch(
+    batch: BatchRequest, genre_service: GenreService = Depends(get_genre_service)
+) -> List[Genre]:
+    return await genre_service.get_by_uuids(batch.ids)
+
+
+@router.get(
+    "/scroll",
+    response_model=CursorPage[Genre],
+    summary="Поиск жанра по наименованию с выдачей по курсору",
+)
+async def scroll_genres(
+    query: str = Query("", description="Get Genre by genre name"),
+    sort: Optional[str] = None,
+    order: str = Query("asc", regex="^(asc|desc)$"),
+    page_size: int = Query(
+        default=10, description="Number of items per page", gt=0, lt=100
+    ),
+    cursor: Optional[str] = Query(None, description="next_cursor of previous page"),
+    genre_service: GenreService = Depends(get_genre_service),
+) -> CursorPage[Genre]:
+    genres, next_cursor = await genre_service.search_by_cursor(
+        query, sort, order, page_size, cursor
+    )
+    return CursorPage(items=genres, next_cursor=next_cursor)
+
+
 @router.get("/{genre_id}", response_model=Genre, summary="Запрос жанра по id")
 async def genre_details(
     genre_id: str, genre_service: GenreService = Depends(get_genre_service)
@@ -1,8 +1,10 @@
 from http import HTTPStatus
-from typing import List
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 
+from models.batch import BatchRequest
+from models.page import CursorPage
 from models.person import FilmRating, PersonFilm
 from services.person import PersonService, get_person_service
 
@@ -30,6 +32,34 @@ async def persons_search(
     return persons
 
 
+@router.get(
+    "/search/scroll",
+    response_model=CursorPage[PersonFilm],
+    summary="Поиск персоны по имени с выдачей по курсору",
+)
+async def persons_search_scroll(
+    query: str = Query("", description="Get Persons by names"),
+    page_size: int = Query(
+        default=10, description="Number of items per page", gt=0, lt=100
+    ),
+    cursor: Optional[str] = Query(None, description="next_cursor of previous page"),
+    person_service: PersonService = Depends(get_person_service),
+) -> CursorPage[PersonFilm]:
+    persons, next_cursor = await person_service.search_by_cursor(
+        search_str=query, page_size=page_size, cursor=cursor
+    )
+    return CursorPage(items=persons, next_cursor=next_cursor)
+
+
+@router.post(
+    "/batch", response_model=list[PersonFilm], summary="Запрос нескольких персон по id"
+)
+async def persons_batch(
+    batch: BatchRequest, person_service: PersonService = Depends(get_person_service)
+) -> List[PersonFilm]:
+    return await person_service.get_by_uuids(batch.ids)
+
+
 @router.get(
     "/{person_id}", response_model=PersonFilm | None, summary="Запрос персоны по id"
 )
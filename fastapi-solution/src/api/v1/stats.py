@@ -0,0 +1,21 @@
+from elasticsearch import AsyncElasticsearch
+from fastapi import APIRouter, Depends
+from redis.asyncio import Redis
+
+from db import elastic, redis
+from db.elastic import get_elastic
+from db.redis import get_redis, local_cache
+
+router = APIRouter()
+
+
+@router.get("", summary="Состояние пулов соединений и локального кэша")
+async def service_stats(
+    redis_client: Redis = Depends(get_redis),
+    es: AsyncElasticsearch = Depends(get_elastic),
+) -> dict:
+    return {
+        "redis": redis.pool_stats(redis_client),
+        "elasticsearch": elastic.pool_stats(es),
+        "local_cache": local_cache.stats(),
+    }
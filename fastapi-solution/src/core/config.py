@@ -17,12 +17,62 @@ class Settings(BaseSettings):
     # Настройки Redis
     redis_host: str = Field("127.0.0.1", alias="REDIS_HOST")
     redis_port: int = Field(6379, alias="REDIS_PORT")
+    # Пул соединений: размер, ожидание свободного соединения, таймауты
+    # чтения и подключения и интервал проверки соединения, в секундах
+    redis_max_connections: int = Field(100, alias="REDIS_MAX_CONNECTIONS")
+    redis_pool_timeout: float = Field(5, alias="REDIS_POOL_TIMEOUT")
+    redis_socket_timeout: float = Field(5, alias="REDIS_SOCKET_TIMEOUT")
+    redis_socket_connect_timeout: float = Field(2, alias="REDIS_SOCKET_CONNECT_TIMEOUT")
+    redis_health_check_interval: int = Field(30, alias="REDIS_HEALTH_CHECK_INTERVAL")
+    redis_retry_on_timeout: bool = Field(True, alias="REDIS_RETRY_ON_TIMEOUT")
 
     # Настройки Elastic
     elastic_host: str = Field("127.0.0.1", alias="ELASTIC_HOST")
     elastic_port: int = Field(9200, alias="ELASTIC_PORT")
     elastic_schema: str = "http://"
+    # Пул HTTP-соединений с узлом, таймаут запроса в секундах и повторы
+    elastic_connections_per_node: int = Field(25, alias="ELASTIC_CONNECTIONS_PER_NODE")
+    elastic_request_timeout: float = Field(10, alias="ELASTIC_REQUEST_TIMEOUT")
+    elastic_max_retries: int = Field(3, alias="ELASTIC_MAX_RETRIES")
+    elastic_retry_on_timeout: bool = Field(True, alias="ELASTIC_RETRY_ON_TIMEOUT")
+    # Сколько точка во времени выгрузки /films/export живет между запросами ее страниц
+    elastic_pit_keep_alive: str = Field("1m", alias="ELASTIC_PIT_KEEP_ALIVE")
     cache_time_life: int = 60 * 60
+    # Число фильмов, которое выгрузка каталога читает из ES одним запросом
+    export_page_size: int = Field(1000, alias="EXPORT_PAGE_SIZE")
+    # Наибольшее число id в одном запросе /batch
+    batch_max_size: int = Field(100, alias="BATCH_MAX_SIZE")
+    # Сколько секунд после истечения значение кэша еще отдается устаревшим,
+    # пока обновляется в фоне
+    cache_stale_time: int = Field(5 * 60, alias="CACHE_STALE_TIME")
+
+    # Локальный кэш процесса перед Redis: размер, время жизни записей
+    # по умолчанию и по пространствам имен ключей, в секундах
+    local_cache_max_size: int = Field(4096, alias="LOCAL_CACHE_MAX_SIZE")
+    local_cache_ttl: float = Field(30, alias="LOCAL_CACHE_TTL")
+    local_cache_ttls: dict[str, float] = Field(
+        {"movies": 60, "genre": 300, "genres": 300, "person": 60},
+        alias="LOCAL_CACHE_TTLS",
+    )
+
+    # Блокировка пересчета значения кэша между процессами: время жизни
+    # блокировки и интервал проверки кэша ожидающими процессами, в секундах
+    cache_lock_timeout: float = Field(10, alias="CACHE_LOCK_TIMEOUT")
+    cache_lock_poll_interval: float = Field(0.05, alias="CACHE_LOCK_POLL_INTERVAL")
+
+    # Значения кэша не короче порога, в байтах, сжимаются zstd с указанным
+    # уровнем сжатия; 0 отключает сжатие
+    cache_compression_threshold: int = Field(1024, alias="CACHE_COMPRESSION_THRESHOLD")
+    cache_compression_level: int = Field(3, alias="CACHE_COMPRESSION_LEVEL")
+
+    # Канал Redis, в который ETL публикует изменившиеся документы, и пауза
+    # перед переподключением к нему, в секундах
+    cache_invalidation_channel: str = Field(
+        "cache_invalidation", alias="CACHE_INVALIDATION_CHANNEL"
+    )
+    cache_invalidation_retry_interval: float = Field(
+        1, alias="CACHE_INVALIDATION_RETRY_INTERVAL"
+    )
 
 
 # Применяем настройки логирования
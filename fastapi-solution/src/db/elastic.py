@@ -2,9 +2,62 @@ from typing import Optional
 
 from elasticsearch import AsyncElasticsearch
 
+from core.config import settings
+
 es: Optional[AsyncElasticsearch] = None
 
 
 # Функция понадобится при внедрении зависимостей
 async def get_elastic() -> AsyncElasticsearch:
     return es
+
+
+def create_elastic() -> AsyncElasticsearch:
+    """Создает клиент Elasticsearch с пулом HTTP-соединений из настроек.
+
+    С каждым узлом держится до elastic_connections_per_node соединений
+    с keep-alive; запросы, упавшие по таймауту, повторяются на другом
+    соединении.
+    """
+    return AsyncElasticsearch(
+        hosts=[
+            f"{settings.elastic_schema}{settings.elastic_host}:{settings.elastic_port}"
+        ],
+        connections_per_node=settings.elastic_connections_per_node,
+        request_timeout=settings.elastic_request_timeout,
+        max_retries=settings.elastic_max_retries,
+        retry_on_timeout=settings.elastic_retry_on_timeout,
+    )
+
+
+def pool_stats(es: AsyncElasticsearch) -> list[dict]:
+    """Возвращает размер пула соединений и число занятых соединений по узлам.
+
+    Число соединений aiohttp хранит в закрытых атрибутах: если в другой
+    версии их нет, вместо значений возвращается None.
+    """
+    stats = []
+    for node in es.transport.node_pool.all():
+        # Сессия aiohttp создается при первом запросе к узлу
+        session = getattr(node, "session", None)
+        if session is None:
+            in_use, idle = 0, 0
+        else:
+            connector = getattr(session, "connector", None)
+            acquired = getattr(connector, "_acquired", None)
+            conns = getattr(connector, "_conns", None)
+            in_use = len(acquired) if acquired is not None else None
+            idle = (
+                sum(len(node_conns) for node_conns in conns.values())
+                if conns is not None
+                else None
+            )
+        stats.append(
+            {
+                "node": node.base_url,
+                "max_connections": settings.elastic_connections_per_node,
+                "in_use": in_use,
+                "idle": idle,
+            }
+        )
+    return stats
@@ -1,10 +1,42 @@
+import asyncio
+import json
 import logging
-from typing import Optional
+import struct
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Iterable, NamedTuple, Optional
 
-from redis.asyncio import Redis
+import zstandard
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import RedisError
+
+from core.config import settings
 
 redis: Optional[Redis] = None
 
+# Снимает блокировку, только если она все еще принадлежит снимающему
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# Сколько секунд хранится отметка о том, что сообщение сброса кэша
+# уже обрабатывает один из процессов
+INVALIDATION_CLAIM_TIMEOUT = 60
+
+# Заголовок значения в Redis: версия формата, способ сжатия, момент устаревания
+CACHE_HEADER = struct.Struct(">BBd")
+CACHE_FORMAT_VERSION = 1
+COMPRESSION_NONE = 0
+COMPRESSION_ZSTD = 1
+
+_compressor = zstandard.ZstdCompressor(level=settings.cache_compression_level)
+_decompressor = zstandard.ZstdDecompressor()
+
 
 # Функция понадобится при внедрении зависимостей
 async def get_redis() -> Redis:
@@ -16,6 +48,43 @@ async def get_redis() -> Redis:
     return redis
 
 
+def create_redis() -> Redis:
+    """Создает клиент Redis с пулом соединений из настроек.
+
+    Пул ограничен redis_max_connections соединениями: когда все они заняты,
+    запрос ждет освобождения соединения не дольше redis_pool_timeout секунд,
+    а не открывает новое.
+    """
+    pool = BlockingConnectionPool(
+        host=settings.redis_host,
+        port=settings.redis_port,
+        max_connections=settings.redis_max_connections,
+        timeout=settings.redis_pool_timeout,
+        socket_timeout=settings.redis_socket_timeout,
+        socket_connect_timeout=settings.redis_socket_connect_timeout,
+        socket_keepalive=True,
+        health_check_interval=settings.redis_health_check_interval,
+        retry_on_timeout=settings.redis_retry_on_timeout,
+    )
+    return Redis.from_pool(pool)
+
+
+def pool_stats(redis: Redis) -> dict:
+    """Возвращает размер пула соединений Redis и число занятых соединений.
+
+    Число соединений пул хранит в закрытых атрибутах: если в другой версии
+    redis-py их нет, вместо значений возвращается None.
+    """
+    pool = redis.connection_pool
+    in_use = getattr(pool, "_in_use_connections", None)
+    idle = getattr(pool, "_available_connections", None)
+    return {
+        "max_connections": getattr(pool, "max_connections", None),
+        "in_use": len(in_use) if in_use is not None else None,
+        "idle": len(idle) if idle is not None else None,
+    }
+
+
 def generate_cache_key(
     index: str,
     params_to_key: dict,
@@ -42,3 +111,587 @@ def generate_cache_key(
 
     # logging.info('Кэш-ключ: {0}'.format(cache_key))
     return cache_key
+
+
+def cache_namespace(cache_key: str) -> str:
+    """Возвращает пространство имен ключа - его часть до первого двоеточия.
+
+    Для ключей generate_cache_key это имя индекса (movies, person),
+    для ключей вида genre:<id> - префикс genre.
+    """
+    return cache_key.split(":", 1)[0]
+
+
+class LocalCache:
+    """Ограниченный LRU-кэш с TTL в памяти процесса.
+
+    Хранит уже провалидированные объекты моделей, поэтому попадание в него
+    не требует ни запроса к Redis, ни десериализации. Время жизни записи
+    задается для каждого пространства имен ключей.
+    """
+
+    def __init__(self, max_size: int, default_ttl: float, ttls: dict[str, float]):
+        """Инициализация кэша.
+
+        Args:
+            max_size: максимальное количество записей
+            default_ttl: время жизни записи в секундах по умолчанию
+            ttls: время жизни записей по пространствам имен ключей
+        """
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.ttls = ttls
+        self._entries: OrderedDict[str, tuple[float, Any, tuple[str, ...]]] = (
+            OrderedDict()
+        )
+        # Ключи записей по тегам - для сброса записей при изменении данных
+        self._tags: defaultdict[str, set[str]] = defaultdict(set)
+        self.hits: defaultdict[str, int] = defaultdict(int)
+        self.misses: defaultdict[str, int] = defaultdict(int)
+
+    def ttl(self, cache_key: str) -> float:
+        """Возвращает время жизни записи для ключа."""
+        return self.ttls.get(cache_namespace(cache_key), self.default_ttl)
+
+    def get(self, cache_key: str) -> Optional[Any]:
+        """Возвращает значение по ключу или None, если его нет или оно устарело."""
+        entry = self._entries.get(cache_key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                self.delete(cache_key)
+            self.misses[cache_namespace(cache_key)] += 1
+            return None
+        self._entries.move_to_end(cache_key)
+        self.hits[cache_namespace(cache_key)] += 1
+        return entry[1]
+
+    def set(self, cache_key: str, value: Any, tags: Iterable[str] = ()):
+        """Сохраняет значение, вытесняя самые давно использованные записи.
+
+        Args:
+            cache_key: ключ кэша
+            value: значение
+            tags: теги данных, от которых зависит значение
+        """
+        ttl = self.ttl(cache_key)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self.delete(cache_key)
+        tags = tuple(tags)
+        self._entries[cache_key] = (time.monotonic() + ttl, value, tags)
+        for tag in tags:
+            self._tags[tag].add(cache_key)
+        while len(self._entries) > self.max_size:
+            self.delete(next(iter(self._entries)))
+
+    def delete(self, cache_key: str):
+        """Удаляет значение по ключу."""
+        entry = self._entries.pop(cache_key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(cache_key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tags: Iterable[str], prefixes: Iterable[str] = ()):
+        """Удаляет значения, помеченные любым из тегов или тегом с префиксом."""
+        prefixes = tuple(prefixes)
+        tags = set(tags)
+        if prefixes:
+            tags.update(tag for tag in self._tags if tag.startswith(prefixes))
+        for tag in tags:
+            for cache_key in list(self._tags.get(tag, ())):
+                self.delete(cache_key)
+
+    def clear(self):
+        """Удаляет все значения."""
+        self._entries.clear()
+        self._tags.clear()
+
+    def stats(self) -> dict:
+        """Возвращает размер кэша и счетчики попаданий и промахов."""
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+        }
+
+
+local_cache = LocalCache(
+    max_size=settings.local_cache_max_size,
+    default_ttl=settings.local_cache_ttl,
+    ttls=settings.local_cache_ttls,
+)
+
+
+def pack_cache_value(payload: bytes | str, ttl: int) -> bytes:
+    """Упаковывает значение для записи в Redis.
+
+    Перед данными пишется заголовок CACHE_HEADER: версия формата, способ
+    сжатия и момент, после которого значение устаревает. Данные не короче
+    cache_compression_threshold байт сжимаются zstd.
+
+    Args:
+        payload: сериализованное значение
+        ttl: время в секундах, в течение которого значение считается свежим
+
+    Returns:
+        Данные для записи в Redis
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    compression = COMPRESSION_NONE
+    if 0 < settings.cache_compression_threshold <= len(payload):
+        payload = _compressor.compress(payload)
+        compression = COMPRESSION_ZSTD
+    header = CACHE_HEADER.pack(CACHE_FORMAT_VERSION, compression, time.time() + ttl)
+    return header + payload
+
+
+def unpack_cache_value(data: bytes) -> Optional[tuple[float, bytes]]:
+    """Разбирает данные из Redis на момент устаревания и значение.
+
+    Данные другой версии формата (например, записанные до ее смены)
+    не разбираются, такое значение считается отсутствующим.
+    """
+    if len(data) < CACHE_HEADER.size:
+        return None
+    version, compression, stale_at = CACHE_HEADER.unpack_from(data)
+    if version != CACHE_FORMAT_VERSION:
+        return None
+    payload = data[CACHE_HEADER.size:]
+    if compression == COMPRESSION_ZSTD:
+        payload = _decompressor.decompress(payload)
+    elif compression != COMPRESSION_NONE:
+        return None
+    return stale_at, payload
+
+
+async def get_from_cache(
+    redis: Redis,
+    cache_key: str,
+    loads: Callable[[bytes], Any],
+    tags: Iterable[str] = (),
+) -> tuple[Optional[Any], bool]:
+    """Читает значение из локального кэша, а при промахе - из Redis.
+
+    Свежее значение, найденное в Redis, десериализуется и сохраняется
+    в локальный кэш.
+
+    Args:
+        redis: соединение с Redis
+        cache_key: ключ кэша
+        loads: функция, восстанавливающая значение из данных Redis
+        tags: теги данных, от которых зависит значение
+
+    Returns:
+        Значение из кэша или None, если его нет, и признак того, что
+        значение устарело и его пора обновить
+    """
+    value = local_cache.get(cache_key)
+    if value is not None:
+        return value, False
+
+    return _load_cached(cache_key, await redis.get(cache_key), loads, tags)
+
+
+def _load_cached(
+    cache_key: str,
+    data: Optional[bytes],
+    loads: Callable[[bytes], Any],
+    tags: Iterable[str],
+) -> tuple[Optional[Any], bool]:
+    if data is None:
+        return None, False
+    unpacked = unpack_cache_value(data)
+    if unpacked is None:
+        return None, False
+    stale_at, payload = unpacked
+    value = loads(payload)
+    stale = stale_at <= time.time()
+    if not stale:
+        local_cache.set(cache_key, value, tags)
+    return value, stale
+
+
+class CacheEntry(NamedTuple):
+    """Значение для записи в кэш."""
+
+    cache_key: str
+    value: Any
+    dumps: Callable[[Any], bytes | str]
+    ex: int
+    tags: tuple[str, ...] = ()
+
+
+# Записи, добавленные к значению, которое сейчас вычисляет get_or_compute
+_related_entries: ContextVar[Optional[list[CacheEntry]]] = ContextVar(
+    "related_entries", default=None
+)
+
+
+def cache_alongside(*entries: CacheEntry):
+    """Добавляет записи к значению, которое вычисляет get_or_compute.
+
+    Записи сохраняются в Redis тем же конвейером, что и само значение,
+    и не стоят отдельного обращения к Redis. В локальный кэш они попадают
+    только при чтении. Так, страница выдачи может
+    заодно сохранить входящие в нее объекты под ключами запросов по id.
+    Вне вычисления get_or_compute записи не сохраняются.
+    """
+    pending = _related_entries.get()
+    if pending is not None:
+        pending.extend(entries)
+
+
+def tag_key(tag: str) -> str:
+    """Ключ индекса тега: ключи кэша с тегом и время их истечения."""
+    return f"cache_tag:{tag}"
+
+
+async def put_to_cache(
+    redis: Redis,
+    cache_key: str,
+    value: Any,
+    dumps: Callable[[Any], bytes | str],
+    ex: int,
+    tags: Iterable[str] = (),
+):
+    """Сохраняет значение в Redis и в локальный кэш.
+
+    Значение считается свежим ex секунд и хранится в Redis еще
+    cache_stale_time секунд, в течение которых отдается устаревшим,
+    пока обновляется в фоне. Ключ добавляется в индексы cache_tag:<тег>
+    каждого из тегов, по которым его найдет delete_tagged.
+
+    Args:
+        redis: соединение с Redis
+        cache_key: ключ кэша
+        value: значение
+        dumps: функция, сериализующая значение для Redis
+        ex: время, в течение которого значение свежее, в секундах
+        tags: теги данных, от которых зависит значение
+    """
+    await put_many_to_cache(
+        redis, [CacheEntry(cache_key, value, dumps, ex, tuple(tags))]
+    )
+
+
+async def put_many_to_cache(
+    redis: Redis,
+    entries: Iterable[CacheEntry],
+    lock: Optional[tuple[str, str]] = None,
+    local: bool = True,
+):
+    """Сохраняет значения в Redis одним конвейером и в локальный кэш.
+
+    Args:
+        redis: соединение с Redis
+        entries: записи кэша
+        lock: ключ и токен блокировки, которую нужно снять тем же конвейером
+        local: сохранить значения и в локальный кэш
+    """
+    entries = list(entries)
+    now = time.time()
+    async with redis.pipeline(transaction=False) as pipe:
+        for entry in entries:
+            hard_ex = entry.ex + settings.cache_stale_time
+            pipe.set(
+                entry.cache_key,
+                pack_cache_value(entry.dumps(entry.value), entry.ex),
+                hard_ex,
+            )
+            for tag in entry.tags:
+                # Индекс тега хранит ключи с временем их истечения
+                pipe.zadd(tag_key(tag), {entry.cache_key: now + hard_ex})
+                pipe.expire(tag_key(tag), hard_ex, gt=True)
+                pipe.expire(tag_key(tag), hard_ex, nx=True)
+        # Истекшие ключи убираются из индексов, чтобы те не росли между сбросами
+        for tag in {tag for entry in entries for tag in entry.tags}:
+            pipe.zremrangebyscore(tag_key(tag), "-inf", now)
+        if lock is not None:
+            pipe.eval(RELEASE_LOCK_SCRIPT, 1, *lock)
+        await pipe.execute()
+    if local:
+        for entry in entries:
+            local_cache.set(entry.cache_key, entry.value, entry.tags)
+
+
+async def get_many_or_compute(
+    redis: Redis,
+    cache_keys: dict[str, str],
+    compute: Callable[[list[str]], Awaitable[dict[str, Any]]],
+    loads: Callable[[bytes], Any],
+    dumps: Callable[[Any], bytes | str],
+    ex: int,
+    tags: Callable[[str], Iterable[str]],
+) -> dict[str, Any]:
+    """Читает из кэша несколько значений, а недостающие вычисляет разом.
+
+    Значения, которых нет в локальном кэше, читаются из Redis одним MGET.
+    Отсутствующие и устаревшие значения вычисляются одним вызовом compute
+    и сохраняются в Redis одним конвейером.
+
+    Args:
+        redis: соединение с Redis
+        cache_keys: ключи кэша по id объектов
+        compute: корутина, возвращающая значения по списку id; объекты,
+            которых нет, в результат не попадают или равны None
+        loads: функция, восстанавливающая значение из данных Redis
+        dumps: функция, сериализующая значение для Redis
+        ex: время, в течение которого значение свежее, в секундах
+        tags: функция, возвращающая теги данных объекта по его id
+
+    Returns:
+        Найденные значения по id объектов
+    """
+    values = {}
+    for item_id, cache_key in cache_keys.items():
+        value = local_cache.get(cache_key)
+        if value is not None:
+            values[item_id] = value
+
+    missing = [item_id for item_id in cache_keys if item_id not in values]
+    if missing:
+        cached = await redis.mget([cache_keys[item_id] for item_id in missing])
+        for item_id, data in zip(missing, cached):
+            value, stale = _load_cached(cache_keys[item_id], data, loads, tags(item_id))
+            if value is not None and not stale:
+                values[item_id] = value
+
+    missing = [item_id for item_id in cache_keys if item_id not in values]
+    if missing:
+        computed = await compute(missing)
+        computed = {
+            item_id: value for item_id, value in computed.items() if value is not None
+        }
+        if computed:
+            await put_many_to_cache(
+                redis,
+                (
+                    CacheEntry(
+                        cache_keys[item_id], value, dumps, ex, tuple(tags(item_id))
+                    )
+                    for item_id, value in computed.items()
+                ),
+            )
+        values.update(computed)
+    return values
+
+
+# Вычисления значений, уже выполняемые в этом процессе: ключ кэша -> задача
+_inflight: dict[str, asyncio.Future] = {}
+
+
+async def get_or_compute(
+    redis: Redis,
+    cache_key: str,
+    compute: Callable[[], Awaitable[Any]],
+    loads: Callable[[bytes], Any],
+    dumps: Callable[[Any], bytes | str],
+    ex: int,
+    tags: Iterable[str] = (),
+) -> Optional[Any]:
+    """Читает значение из кэша, а при промахе вычисляет его один раз.
+
+    Одновременные промахи по одному ключу в процессе ожидают одно и то же
+    вычисление. Между процессами вычисление защищено блокировкой в Redis:
+    значение вычисляет тот, кто ее взял, остальные ждут его появления в кэше.
+    Устаревшее значение отдается сразу, а обновляется в фоне.
+    Значение None не кэшируется. Записи, которые compute передаст
+    в cache_alongside, сохраняются вместе со значением.
+
+    Args:
+        redis: соединение с Redis
+        cache_key: ключ кэша
+        compute: корутина-функция, вычисляющая значение (например, запрос в ES)
+        loads: функция, восстанавливающая значение из данных Redis
+        dumps: функция, сериализующая значение для Redis
+        ex: время, в течение которого значение свежее, в секундах
+        tags: теги данных, от которых зависит значение
+
+    Returns:
+        Значение из кэша или вычисленное значение
+    """
+    value, stale = await get_from_cache(redis, cache_key, loads, tags)
+    if value is not None:
+        if stale:
+            task = _compute_in_flight(
+                redis, cache_key, compute, loads, dumps, ex, tags, wait=False
+            )
+            task.add_done_callback(_log_failed_refresh)
+        return value
+
+    task = _compute_in_flight(
+        redis, cache_key, compute, loads, dumps, ex, tags, wait=True
+    )
+    # Отмена одного запроса не должна отменять общее вычисление
+    return await asyncio.shield(task)
+
+
+def _compute_in_flight(
+    redis: Redis,
+    cache_key: str,
+    compute: Callable[[], Awaitable[Any]],
+    loads: Callable[[bytes], Any],
+    dumps: Callable[[Any], bytes | str],
+    ex: int,
+    tags: Iterable[str],
+    wait: bool,
+) -> asyncio.Future:
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(
+            _compute_once(redis, cache_key, compute, loads, dumps, ex, tags, wait)
+        )
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda _: _inflight.pop(cache_key, None))
+    return task
+
+
+def _log_failed_refresh(task: asyncio.Future):
+    if not task.cancelled() and task.exception():
+        logging.error("Не удалось обновить значение кэша: %s", task.exception())
+
+
+async def _compute_once(
+    redis: Redis,
+    cache_key: str,
+    compute: Callable[[], Awaitable[Any]],
+    loads: Callable[[bytes], Any],
+    dumps: Callable[[Any], bytes | str],
+    ex: int,
+    tags: Iterable[str],
+    wait: bool,
+) -> Optional[Any]:
+    tags = tuple(tags)
+    lock_key = f"lock:{cache_key}"
+    token = uuid.uuid4().hex
+    lock_timeout = settings.cache_lock_timeout
+    if not await redis.set(lock_key, token, nx=True, px=int(lock_timeout * 1000)):
+        if not wait:
+            # Устаревшее значение уже обновляет другой процесс
+            return None
+        # Значение вычисляет другой процесс: ждем его, пока жива блокировка
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(settings.cache_lock_poll_interval)
+            value, _ = await get_from_cache(redis, cache_key, loads, tags)
+            if value is not None:
+                return value
+            if not await redis.exists(lock_key):
+                break
+        logging.warning("Не дождались значения по ключу %s, вычисляем", cache_key)
+        token = None
+
+    related = []
+    _related_entries.set(related)
+    try:
+        value = await compute()
+        entries = related
+        if value is not None:
+            entries = [CacheEntry(cache_key, value, dumps, ex, tags), *related]
+        # Блокировка снимается тем же конвейером, что сохраняет значение.
+        # Сопутствующие записи еще никто не запрашивал: в локальный кэш
+        # попадает только само значение, чтобы не вытеснять нужные записи
+        await put_many_to_cache(
+            redis, entries, (lock_key, token) if token else None, local=False
+        )
+        token = None
+        if value is not None:
+            local_cache.set(cache_key, value, tags)
+        return value
+    finally:
+        if token:
+            await redis.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+
+async def delete_tagged(
+    redis: Redis, tags: Iterable[str], prefixes: Iterable[str] = ()
+):
+    """Удаляет из Redis значения, помеченные тегами, и индексы этих тегов.
+
+    Args:
+        redis: соединение с Redis
+        tags: теги изменившихся данных
+        prefixes: префиксы тегов, все значения с которыми нужно удалить
+    """
+    tag_keys = {tag_key(tag) for tag in tags}
+    for prefix in prefixes:
+        tag_keys.update(
+            [key.decode() async for key in redis.scan_iter(match=tag_key(f"{prefix}*"))]
+        )
+    if not tag_keys:
+        return
+    now = time.time()
+    async with redis.pipeline(transaction=False) as pipe:
+        for key in tag_keys:
+            pipe.zrangebyscore(key, now, "+inf")
+        members = await pipe.execute()
+    cache_keys = set().union(*members)
+    await redis.delete(*tag_keys, *cache_keys)
+    logging.info(
+        "Сброшено %s значений кэша по %s тегам", len(cache_keys), len(tag_keys)
+    )
+
+
+async def handle_invalidation(redis: Redis, message: bytes):
+    """Сбрасывает кэш по сообщению ETL об изменении документов индекса.
+
+    Сообщение имеет вид {"index": <индекс>, "ids": [<id документа>, ...],
+    "message_id": <id сообщения>}, ids равен null, если изменился весь
+    индекс. Сбрасываются значения, зависящие от индекса в целом (списки
+    и поиск), и значения с тегами <индекс>:<id> изменившихся документов.
+    """
+    change = json.loads(message)
+    index, ids = change["index"], change["ids"]
+    if ids is None:
+        tags, prefixes = [index], [f"{index}:"]
+    else:
+        tags, prefixes = [index, *(f"{index}:{id_}" for id_ in ids)], []
+    local_cache.invalidate(tags, prefixes)
+
+    # Значения в Redis общие: их удаляет один процесс из получивших сообщение
+    message_id = change.get("message_id")
+    if message_id is None or await redis.set(
+        f"invalidation:{message_id}",
+        1,
+        nx=True,
+        ex=INVALIDATION_CLAIM_TIMEOUT,
+    ):
+        await delete_tagged(redis, tags, prefixes)
+
+
+async def listen_for_invalidations(redis: Redis):
+    """Слушает канал сброса кэша, пока задачу не отменят.
+
+    Сообщения ожидаются не дольше redis_health_check_interval секунд, чтобы
+    таймаут сокета не обрывал соединение, пока сообщений нет, а проверка
+    соединения выполнялась между ними.
+
+    После потери соединения локальный кэш очищается целиком: сообщения,
+    пришедшие за это время, могли быть пропущены.
+    """
+    while True:
+        try:
+            async with redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(settings.cache_invalidation_channel)
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True,
+                        timeout=settings.redis_health_check_interval,
+                    )
+                    if message is None:
+                        continue
+                    try:
+                        await handle_invalidation(redis, message["data"])
+                    except (ValueError, KeyError) as e:
+                        logging.error("Некорректное сообщение сброса кэша: %s", e)
+        except RedisError as e:
+            logging.error("Потеряно соединение с каналом сброса кэша: %s", e)
+            local_cache.clear()
+            await asyncio.sleep(settings.cache_invalidation_retry_interval)
@@ -1,24 +1,24 @@
+import asyncio
 from contextlib import asynccontextmanager
 
-from elasticsearch import AsyncElasticsearch
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
-from redis.asyncio import Redis
 
-from api.v1 import films, genres, persons
+from api.v1 import films, genres, persons, stats
 from core.config import settings
 from db import elastic, redis
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    redis.redis = Redis(host=settings.redis_host, port=settings.redis_port)
-    elastic.es = AsyncElasticsearch(
-        hosts=[
-            f"{settings.elastic_schema}{settings.elastic_host}:{settings.elastic_port}"
-        ]
+    redis.redis = redis.create_redis()
+    elastic.es = elastic.create_elastic()
+    # Сброс кэша по сообщениям ETL об изменившихся документах
+    invalidation_listener = asyncio.create_task(
+        redis.listen_for_invalidations(redis.redis)
     )
     yield
+    invalidation_listener.cancel()
     await redis.redis.aclose()
     await elastic.es.close()
 
@@ -34,3 +34,4 @@ app = FastAPI(
 app.include_router(films.router, prefix="/api/v1/films", tags=["films"])
 app.include_router(persons.router, prefix="/api/v1/persons", tags=["persons"])
 app.include_router(genres.router, prefix="/api/v1/genres", tags=["genres"])
+app.include_router(stats.router, prefix="/api/v1/stats", tags=["stats"])
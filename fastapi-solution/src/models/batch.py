@@ -0,0 +1,11 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from core.config import settings
+
+
+class BatchRequest(BaseModel):
+    """Схема запроса нескольких объектов по id."""
+
+    ids: List[str] = Field(min_length=1, max_length=settings.batch_max_size)
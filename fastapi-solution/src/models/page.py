@@ -0,0 +1,12 @@
+from typing import Generic, List, Optional, TypeVar
+
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+
+class CursorPage(BaseModel, Generic[T]):
+    """Схема страницы выдачи по курсору."""
+
+    items: List[T]
+    next_cursor: Optional[str] = None
@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import json
+from http import HTTPStatus
+from typing import AsyncIterator, Optional
+
+from elasticsearch import AsyncElasticsearch, BadRequestError
+from fastapi import HTTPException
+
+from core.config import settings
+
+
+def query_fingerprint(index: str, body: dict) -> str:
+    """Отпечаток запроса, к которому выдан курсор: индекс, query и sort."""
+    data = json.dumps({"index": index, **body}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+
+def encode_cursor(search_after: list, fingerprint: str) -> str:
+    """Упаковывает позицию в выдаче в непрозрачный курсор."""
+    data = json.dumps(
+        {"after": search_after, "query": fingerprint}, separators=(",", ":")
+    )
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str, fingerprint: str) -> list:
+    """Распаковывает курсор, выданный encode_cursor для того же запроса."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        search_after, cursor_fingerprint = data["after"], data["query"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid cursor")
+    if cursor_fingerprint != fingerprint:
+        # Курсор выдан для других параметров запроса (сортировки, фильтров)
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Cursor does not match the request parameters",
+        )
+    return search_after
+
+
+def page_search_body(body: dict, search_after: Optional[list], page_size: int) -> dict:
+    """Тело запроса страницы, следующей за search_after."""
+    body = {
+        **body,
+        "size": page_size,
+        # Порядок документов с равными значениями сортировки задает uuid
+        "sort": [*body.get("sort", ["_score"]), {"uuid": "asc"}],
+    }
+    if search_after is not None:
+        body["search_after"] = search_after
+    return body
+
+
+def pit_search_body(
+    body: dict, pit_id: str, search_after: Optional[list], page_size: int
+) -> dict:
+    """Тело запроса страницы, следующей за search_after, в точке во времени."""
+    body = {
+        **body,
+        "size": page_size,
+        "pit": {"id": pit_id, "keep_alive": settings.elastic_pit_keep_alive},
+        # Порядок документов с равными значениями сортировки задает _shard_doc
+        "sort": [*body.get("sort", ["_score"]), {"_shard_doc": "asc"}],
+    }
+    if search_after is not None:
+        body["search_after"] = search_after
+    return body
+
+
+async def search_after_page(
+    elastic: AsyncElasticsearch,
+    index: str,
+    body: dict,
+    page_size: int,
+    cursor: Optional[str] = None,
+) -> tuple[list[dict], Optional[str]]:
+    """Получить страницу выдачи ES по курсору.
+
+    Выдача листается через search_after, поэтому стоимость страницы не
+    зависит от ее номера и не ограничена max_result_window. Между запросами
+    страниц ES не держит для клиента ни точки во времени, ни другого
+    контекста поиска: клиент может бросить выдачу на любой странице. Цена
+    этого - документы, изменившиеся между запросами страниц, могут
+    пропасть из выдачи или повториться, как и при постраничной выдаче.
+    Страницы не кэшируются: курсор у каждого клиента свой.
+
+    Parameters:
+        elastic: экземпляр elastic'а
+        index: индекс (алиас) выдачи
+        body: тело запроса с query и sort, без from и size
+        page_size: размер страницы выдачи
+        cursor: курсор следующей страницы; без него выдача начинается сначала
+
+    Returns:
+        документы страницы и курсор следующей страницы (None на последней)
+    """
+    fingerprint = query_fingerprint(index, body)
+    search_after = decode_cursor(cursor, fingerprint) if cursor else None
+    try:
+        result = await elastic.search(
+            index=index, body=page_search_body(body, search_after, page_size)
+        )
+    except BadRequestError:
+        # ES отверг запрос, например search_after не подходит к сортировке
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="Invalid cursor" if cursor else "Invalid request",
+        )
+
+    hits = result["hits"]["hits"]
+    if len(hits) < page_size:
+        return hits, None
+    return hits, encode_cursor(hits[-1]["sort"], fingerprint)
+
+
+async def open_point_in_time(elastic: AsyncElasticsearch, index: str) -> str:
+    """Открыть точку во времени индекса для обхода его выдачи.
+
+    Returns:
+        id точки во времени для iter_search_after
+    """
+    pit = await elastic.open_point_in_time(
+        index=index, keep_alive=settings.elastic_pit_keep_alive
+    )
+    return pit["id"]
+
+
+async def iter_search_after(
+    elastic: AsyncElasticsearch, pit_id: str, body: dict, page_size: int
+) -> AsyncIterator[dict]:
+    """Обойти всю выдачу ES страницами search_after в одной точке во времени.
+
+    В памяти держится не больше одной страницы выдачи. Точка во времени
+    закрывается и тогда, когда обход прерван, например отключением клиента.
+
+    Parameters:
+        elastic: экземпляр elastic'а
+        pit_id: точка во времени, открытая open_point_in_time; обход ее закрывает
+        body: тело запроса с query и sort, без from и size
+        page_size: размер страницы выдачи
+
+    Returns:
+        документы выдачи по одному
+    """
+    search_after = None
+    try:
+        while True:
+            result = await elastic.search(
+                body=pit_search_body(body, pit_id, search_after, page_size)
+            )
+            hits = result["hits"]["hits"]
+            pit_id = result.get("pit_id", pit_id)
+            for hit in hits:
+                yield hit
+            if len(hits) < page_size:
+                return
+            search_after = hits[-1]["sort"]
+    finally:
+        await elastic.close_point_in_time(id=pit_id)
@@ -1,8 +1,10 @@
+import json
 import logging
-from functools import lru_cache
+from contextlib import aclosing
+from functools import lru_cache, partial
 from http import HTTPStatus
 from pprint import pformat
-from typing import Optional
+from typing import AsyncIterator, Optional
 
 from elasticsearch import AsyncElasticsearch, NotFoundError
 from fastapi import Depends, HTTPException
@@ -11,9 +13,12 @@ from redis.asyncio import Redis
 
 from core.config import settings
 from db.elastic import get_elastic
-from db.redis import generate_cache_key, get_redis
+from db.redis import (CacheEntry, cache_alongside, generate_cache_key,
+                      get_many_or_compute, get_or_compute, get_redis)
 from models.film import Film, FilmDetailed
 from models.genre import Genre
+from services.cursor import (iter_search_after, open_point_in_time,
+                             search_after_page)
 
 FILM_ADAPTER = TypeAdapter(list[Film])
 
@@ -21,6 +26,44 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+def film_cache_key(film_uuid: str) -> str:
+    """Ключ кэша детальной информации о фильме."""
+    return generate_cache_key("movies", {"uuid": film_uuid})
+
+
+def film_from_source(source: dict) -> FilmDetailed:
+    """Собирает детальную информацию о фильме из документа ES."""
+    genres = source.get("genre", [])
+    genre_objs = [Genre(**genre) for genre in genres]
+    film_data = {
+        "uuid": source.get("uuid"),
+        "title": source.get("title"),
+        "description": source.get("description"),
+        "imdb_rating": source.get("imdb_rating"),
+        "genre": genre_objs,
+        "directors": source.get("directors", []),
+        "actors": source.get("actors", []),
+        "writers": source.get("writers", []),
+    }
+    return FilmDetailed(**film_data)
+
+
+def cache_film_details(hits: list[dict]):
+    """Кэширует фильмы из выдачи ES как ответы на запрос фильма по id."""
+    cache_alongside(
+        *(
+            CacheEntry(
+                film_cache_key(hit["_id"]),
+                film_from_source(hit["_source"]),
+                FilmDetailed.model_dump_json,
+                settings.cache_time_life,
+                (f"movies:{hit['_id']}",),
+            )
+            for hit in hits
+        )
+    )
+
+
 class FilmService:
     """Сервис для получения детальной информации по фильму из ES."""
 
@@ -45,18 +88,42 @@ class FilmService:
         Returns:
             детальная информация о фильме
         """
-        # Получаем данные из кеша
-        film = await self._get_film_from_cache(film_uuid)
-        if not film:
-            # Если фильма нет в кеше, то ищем его в Elasticsearch
-            film = await self._get_film_from_elastic(film_uuid)
-            if not film:
-                # Если он отсутствует в Elasticsearch, значит, фильма вообще нет в базе
-                return None
-            # Сохраняем фильм в кеш
-            await self._put_film_to_cache(film)
-
-        return film
+        # Берем фильм из кеша, а если его там нет - ищем в Elasticsearch
+        # и сохраняем в кеш. Если фильма нет и в Elasticsearch, значит,
+        # его вообще нет в базе
+        cache_key = film_cache_key(film_uuid)
+        # pydantic предоставляет удобное API для создания объекта моделей из json
+        return await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(self._get_film_from_elastic, film_uuid),
+            FilmDetailed.model_validate_json,
+            FilmDetailed.model_dump_json,
+            settings.cache_time_life,
+            tags=[f"movies:{film_uuid}"],
+        )
+
+    async def get_by_uuids(self, film_uuids: list[str]) -> list[FilmDetailed]:
+        """Получить детальную информацию о нескольких фильмах по их id.
+
+        Parameters:
+            film_uuids: uuid фильмов
+
+        Returns:
+            детальная информация о найденных фильмах в порядке film_uuids
+        """
+        # Ключи те же, что у get_by_uuid, - кэш у запросов общий
+        cache_keys = {film_uuid: film_cache_key(film_uuid) for film_uuid in film_uuids}
+        films = await get_many_or_compute(
+            self.redis,
+            cache_keys,
+            self._get_films_from_elastic,
+            FilmDetailed.model_validate_json,
+            FilmDetailed.model_dump_json,
+            settings.cache_time_life,
+            tags=lambda film_uuid: [f"movies:{film_uuid}"],
+        )
+        return [films[film_uuid] for film_uuid in cache_keys if film_uuid in films]
 
     # 2.1. получение фильма из ES по id
     async def _get_film_from_elastic(self, film_id: str) -> Optional[FilmDetailed]:
@@ -64,57 +131,18 @@ class FilmService:
             doc = await self.elastic.get(index="movies", id=film_id)
         except NotFoundError:
             return None
-        source = doc["_source"]
         logger.debug(pformat(doc["_source"]))
-        genres = source.get("genre", [])
-        genre_objs = [Genre(**genre) for genre in genres]
-        film_data = {
-            "uuid": source.get("uuid"),
-            "title": source.get("title"),
-            "description": source.get("description"),
-            "imdb_rating": source.get("imdb_rating"),
-            "genre": genre_objs,
-            "directors": source.get("directors", []),
-            "actors": source.get("actors", []),
-            "writers": source.get("writers", []),
+        return film_from_source(doc["_source"])
+
+    async def _get_films_from_elastic(
+        self, film_ids: list[str]
+    ) -> dict[str, FilmDetailed]:
+        docs = await self.elastic.mget(index="movies", ids=film_ids)
+        return {
+            doc["_id"]: film_from_source(doc["_source"])
+            for doc in docs["docs"]
+            if doc.get("found")
         }
-        return FilmDetailed(**film_data)
-
-    # 3.1. получение фильма из кэша по id
-    async def _get_film_from_cache(self, film_uuid: str) -> Optional[FilmDetailed]:
-        params_to_key = {
-            "uuid": film_uuid,
-        }
-        cache_key = generate_cache_key("movies", params_to_key)
-
-        film_data = await self.redis.get(cache_key)
-        if not film_data:
-            return None
-
-        logging.info("Взято из кэша по ключу: {0}".format(cache_key))
-        # pydantic предоставляет удобное API для создания объекта моделей из json
-        return FilmDetailed.model_validate_json(film_data)  # возвращаем
-
-    # десериализованный объект Film
-
-    # 4.1. сохранение фильма в кэш по id:
-    async def _put_film_to_cache(self, film: Film):
-        # Сохраняем данные о фильме, используя команду set
-        # Выставляем время жизни кеша — CACHE_TIME_LIFE
-        # https://redis.io/commands/set/
-        # pydantic позволяет сериализовать модель в json
-
-        # подготовка к генерации ключа
-        params_to_key = {
-            "uuid": film.uuid,
-        }
-        cache_key = generate_cache_key("movies", params_to_key)
-
-        await self.redis.set(
-            cache_key,
-            film.model_dump_json(),
-            settings.cache_time_life,
-        )
 
 
 class MultipleFilmsService:
@@ -130,12 +158,8 @@ class MultipleFilmsService:
         """
         self.redis = redis
         self.elastic = elastic
-
-    async def get_by_uuid(self, uuid: str):
-        response = await self.elastic.get(index="movies", id=uuid)
-        if not response["found"]:
-            return None
-        return response["_source"]
+        # Фильм, похожие на который запрошены, берется из кэша фильмов по id
+        self.film_service = FilmService(redis, elastic)
 
     # 1.2. получение страницы списка фильмов отсортированных по популярности
     async def get_multiple_films(
@@ -169,25 +193,27 @@ class MultipleFilmsService:
         # создаём ключ для кэша
         cache_key = generate_cache_key("movies", params_to_key)
 
-        # запрашиваем инфо в кэше по ключу
-        films_page = await self._get_multiple_films_from_cache(cache_key)
-        if not films_page:
-            # если в кэше нет значения по этому ключу, делаем запрос в ES
-            films_page = await self._get_multiple_films_from_elastic(
+        # запрашиваем инфо в кэше по ключу, если в кэше нет значения
+        # по этому ключу, делаем запрос в ES и кэшируем результат
+        # (пустой результат тоже)
+        films_page = await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(
+                self._get_multiple_films_from_elastic,
                 desc_order=desc_order,
                 page_size=page_size,
                 page_number=page_number,
                 genre=genre,
                 similar=similar,
-            )
-            # Кэшируем результат (пустой результат тоже)
-            await self._put_multiple_films_to_cache(
-                cache_key=cache_key,
-                films=films_page,
-            )
-
-            if not films_page:
-                return None
+            ),
+            FILM_ADAPTER.validate_json,
+            FILM_ADAPTER.dump_json,
+            settings.cache_time_life,
+            tags=["movies"],
+        )
+        if not films_page:
+            return None
 
         return films_page
 
@@ -217,19 +243,105 @@ class MultipleFilmsService:
         # создаём ключ для кэша
         cache_key = generate_cache_key("movies", params_to_key)
 
-        # запрашиваем инфо в кэше
-        films_page = await self._get_multiple_films_from_cache(cache_key)
-        if not films_page:
-            films_page = await self._fulltext_search_films_in_elastic(
+        # запрашиваем инфо в кэше, а при промахе ищем в ES и сохраняем
+        # поиск по фильму в кеш (даже если поиск не дал результата)
+        return await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(
+                self._fulltext_search_films_in_elastic,
                 query=query,
                 page_number=page_number,
                 page_size=page_size,
-            )
+            ),
+            FILM_ADAPTER.validate_json,
+            FILM_ADAPTER.dump_json,
+            settings.cache_time_life,
+            tags=["movies"],
+        )
 
-        # Сохраняем поиск по фильму в кеш (даже если поиск не дал результата)
-        await self._put_multiple_films_to_cache(cache_key, films_page)
+    async def get_multiple_films_by_cursor(
+        self,
+        desc_order: bool,
+        page_size: int,
+        cursor: Optional[str] = None,
+        genre: Optional[str] = None,
+        similar: Optional[str] = None,
+    ) -> tuple[list[Film], Optional[str]]:
+        """Получение страницы фильмов из elastic по курсору.
 
-        return films_page
+        Parameters:
+            desc_order: порядок сортировки (True: убывающий, False: возрастающий)
+            page_size: количество объектов на странице выдачи
+            cursor: курсор страницы из предыдущего ответа; без него - первая страница
+            genre: id жанра, по которому нужно фильтровать фильмы
+            similar: id фильма, по чьим жанрам нужно фильтровать фильмы
+
+        Returns:
+            список фильмов (краткий вариант объекта) и курсор следующей страницы
+        """
+        hits, next_cursor = await search_after_page(
+            self.elastic,
+            "movies",
+            await self._films_query(similar, genre, desc_order),
+            page_size,
+            cursor,
+        )
+        return [Film(**hit["_source"]) for hit in hits], next_cursor
+
+    async def search_films_by_cursor(
+        self,
+        query: str,
+        page_size: int,
+        cursor: Optional[str] = None,
+    ) -> tuple[list[Film], Optional[str]]:
+        """Полнотекстовый поиск фильмов с выдачей по курсору.
+
+        Parameters:
+            query: строка запроса - предполагаемый вариант (или часть) названия фильма
+            page_size: размер страницы выдачи
+            cursor: курсор страницы из предыдущего ответа; без него - первая страница
+
+        Returns:
+            список фильмов и курсор следующей страницы
+        """
+        hits, next_cursor = await search_after_page(
+            self.elastic,
+            "movies",
+            {"query": {"match": {"title": query}}},
+            page_size,
+            cursor,
+        )
+        return [Film(**hit["_source"]) for hit in hits], next_cursor
+
+    async def export_films(
+        self, fields: Optional[list[str]] = None
+    ) -> AsyncIterator[str]:
+        """Выгрузка всего каталога фильмов в формате NDJSON.
+
+        Фильмы читаются из ES страницами search_after и не кэшируются.
+        Точка во времени открывается до начала ответа: если ES недоступен,
+        клиент получает ошибку, а не пустую выгрузку со статусом 200.
+
+        Parameters:
+            fields: поля фильма в выгрузке; по умолчанию - все поля
+
+        Returns:
+            строки NDJSON, по одному фильму в строке
+        """
+        body = {"query": {"match_all": {}}, "sort": []}
+        if fields:
+            body["_source"] = fields
+        pit_id = await open_point_in_time(self.elastic, "movies")
+        return self._export_lines(pit_id, body)
+
+    async def _export_lines(self, pit_id: str, body: dict) -> AsyncIterator[str]:
+        # aclosing закрывает точку во времени сразу, если клиент отключился
+        async with aclosing(
+            iter_search_after(self.elastic, pit_id, body, settings.export_page_size)
+        ) as hits:
+            async for hit in hits:
+                yield json.dumps(hit["_source"], ensure_ascii=False) + "\n"
 
     async def _get_multiple_films_from_elastic(
         self,
@@ -239,9 +351,36 @@ class MultipleFilmsService:
         page_size: int = 50,
         page_number: int = 1,
     ):
+        query = await self._films_query(similar, genre, desc_order)
+        query["size"] = page_size
+        query["from"] = (page_number - 1) * page_size
+        logging.info(f"Query to Elasticsearch: {pformat(query)}")
+        try:
+            similar_response = await self.elastic.search(index="movies", body=query)
+            logging.debug(f"Response from Elasticsearch: {pformat(similar_response)}")
+        except Exception as e:
+            logging.error(f"Error while querying Elasticsearch: {str(e)}")
+            raise HTTPException(
+                status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(e)
+            )
+
+        if not similar_response["hits"]["hits"]:
+            return []
+        cache_film_details(similar_response["hits"]["hits"])
+
+        films_page = [
+            Film(**hit["_source"]) for hit in similar_response["hits"]["hits"]
+        ]
+        return films_page
+
+    async def _films_query(
+        self,
+        similar: Optional[str],
+        genre: Optional[str],
+        desc_order: bool,
+    ) -> dict:
+        """Запрос фильмов жанра или похожих фильмов, отсортированных по рейтингу."""
         query = {
-            "size": page_size,
-            "from": (page_number - 1) * page_size,
             "sort": [{"imdb_rating": {"order": "desc" if desc_order else "asc"}}],
             "query": {"bool": {"must": [], "filter": []}},
         }
@@ -249,10 +388,10 @@ class MultipleFilmsService:
         if similar:
             logging.info("similar: %s", similar)
 
-            similar_film = await self.get_by_uuid(similar)
+            similar_film = await self.film_service.get_by_uuid(similar)
             logging.info("similar film retrieved: %s", similar_film)
-            if similar_film and similar_film.get("genre"):
-                first_genre_uuid = similar_film["genre"][0]["uuid"]
+            if similar_film and similar_film.genre:
+                first_genre_uuid = similar_film.genre[0].uuid
                 logging.info("first_genre_uuid: %s", first_genre_uuid)
                 query["query"]["bool"]["filter"].append(
                     {
@@ -271,23 +410,7 @@ class MultipleFilmsService:
                 {"nested": {"path": "genre", "query": {"term": {"genre.uuid": genre}}}}
             )
             logging.info("genre: %s", genre)
-        logging.info(f"Query to Elasticsearch: {pformat(query)}")
-        try:
-            similar_response = await self.elastic.search(index="movies", body=query)
-            logging.debug(f"Response from Elasticsearch: {pformat(similar_response)}")
-        except Exception as e:
-            logging.error(f"Error while querying Elasticsearch: {str(e)}")
-            raise HTTPException(
-                status_code=HTTPStatus.INTERNAL_SERVER_ERROR, detail=str(e)
-            )
-
-        if not similar_response["hits"]["hits"]:
-            return []
-
-        films_page = [
-            Film(**hit["_source"]) for hit in similar_response["hits"]["hits"]
-        ]
-        return films_page
+        return query
 
     # 2.3 Полнотекстовый поиск по фильмам:
     async def _fulltext_search_films_in_elastic(
@@ -305,26 +428,9 @@ class MultipleFilmsService:
             },
         )
         logging.debug(search_results)
+        cache_film_details(search_results["hits"]["hits"])
         return [Film(**hit["_source"]) for hit in search_results["hits"]["hits"]]
 
-    # 3.2. получение страницы списка фильмов отсортированных по популярности из кэша
-    async def _get_multiple_films_from_cache(self, cache_key: str):
-        films_data = await self.redis.get(cache_key)
-        if not films_data:
-            logging.info("Не найдено в кэш")
-            return None
-
-        logging.info("Взято из кэша по ключу: {0}".format(cache_key))
-        return FILM_ADAPTER.validate_json(films_data)
-
-    # 4.2. сохранение страницы фильмов (отсортированных по популярности) в кэш:
-    async def _put_multiple_films_to_cache(self, cache_key: str, films):
-        await self.redis.set(
-            cache_key,
-            FILM_ADAPTER.dump_json(films),
-            settings.cache_time_life,
-        )
-
 
 # get_film_service — это провайдер FilmService.
 # С помощью Depends он сообщает, что ему необходимы Redis и Elasticsearch
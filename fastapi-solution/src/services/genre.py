@@ -1,14 +1,19 @@
-import json
-from functools import lru_cache
+from functools import lru_cache, partial
 from typing import List, Optional
 
 from elasticsearch import AsyncElasticsearch, NotFoundError
 from fastapi import Depends, HTTPException
+from pydantic import TypeAdapter
 from redis.asyncio import Redis
 
 from db.elastic import get_elastic
-from db.redis import get_redis
+from db.redis import (CacheEntry, cache_alongside, get_many_or_compute,
+                      get_or_compute, get_redis)
 from models.genre import Genre
+from services.cursor import search_after_page
+
+# Страница поиска жанров и общее число найденных жанров
+GENRES_PAGE_ADAPTER = TypeAdapter(tuple[List[Genre], int])
 
 
 class GenreService:
@@ -20,20 +25,44 @@ class GenreService:
 
     async def get_by_uuid(self, genre_id: str) -> Optional[Genre]:
         cache_key = f"genre:{genre_id}"
+        return await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(self._get_genre_from_elastic, genre_id),
+            Genre.model_validate_json,
+            Genre.model_dump_json,
+            ex=300,
+            tags=[f"genres:{genre_id}"],
+        )  # Кеш на 5 минут
 
-        cached_genre = await self.redis.get(cache_key)
-        if cached_genre:
-            return Genre(**json.loads(cached_genre))
-
+    async def get_by_uuids(self, genre_ids: List[str]) -> List[Genre]:
+        # Ключи те же, что у get_by_uuid, - кэш у запросов общий
+        cache_keys = {genre_id: f"genre:{genre_id}" for genre_id in genre_ids}
+        genres = await get_many_or_compute(
+            self.redis,
+            cache_keys,
+            self._get_genres_from_elastic,
+            Genre.model_validate_json,
+            Genre.model_dump_json,
+            ex=300,
+            tags=lambda genre_id: [f"genres:{genre_id}"],
+        )
+        return [genres[genre_id] for genre_id in cache_keys if genre_id in genres]
+
+    async def _get_genres_from_elastic(self, genre_ids: List[str]) -> dict[str, Genre]:
+        docs = await self.elastic.mget(index="genres", ids=genre_ids)
+        return {
+            doc["_id"]: Genre(**doc["_source"])
+            for doc in docs["docs"]
+            if doc.get("found")
+        }
+
+    async def _get_genre_from_elastic(self, genre_id: str) -> Optional[Genre]:
         try:
             doc = await self.elastic.get(index="genres", id=genre_id)
         except NotFoundError:
             return None
-        genre = Genre(**doc["_source"])
-        await self.redis.set(
-            cache_key, genre.model_dump_json(), ex=300
-        )  # Кеш на 5 минут
-        return genre
+        return Genre(**doc["_source"])
 
     async def search(
         self,
@@ -44,13 +73,70 @@ class GenreService:
         page_size: int = 10,
     ) -> (List[Genre], int):
         cache_key = f"genres:search:{query}:{sort}:{order}:{page}:{page_size}"
-        cached_genres = await self.redis.get(cache_key)
-        if cached_genres:
-            data = json.loads(cached_genres)
-            return [Genre.model_validate_json(genre) for genre in data["items"]], data[
-                "total"
-            ]
+        return await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(self._search_in_elastic, query, sort, order, page, page_size),
+            GENRES_PAGE_ADAPTER.validate_json,
+            GENRES_PAGE_ADAPTER.dump_json,
+            ex=300,
+            tags=["genres"],
+        )  # Кеш на 5 минут
 
+    async def search_by_cursor(
+        self,
+        query: Optional[str] = None,
+        sort: Optional[str] = None,
+        order: str = "asc",
+        page_size: int = 10,
+        cursor: Optional[str] = None,
+    ) -> (List[Genre], Optional[str]):
+        hits, next_cursor = await search_after_page(
+            self.elastic,
+            "genres",
+            self._search_body(query, sort, order),
+            page_size,
+            cursor,
+        )
+        return [Genre(**hit["_source"]) for hit in hits], next_cursor
+
+    async def _search_in_elastic(
+        self,
+        query: Optional[str],
+        sort: Optional[str],
+        order: str,
+        page: int,
+        page_size: int,
+    ) -> (List[Genre], int):
+        body = self._search_body(query, sort, order)
+        body["from"] = (page - 1) * page_size
+        body["size"] = page_size
+
+        result = await self.elastic.search(index="genres", body=body)
+        genres = [Genre(**hit["_source"]) for hit in result["hits"]["hits"]]
+        total = result["hits"]["total"]["value"]
+
+        if (page - 1) * page_size >= total:
+            raise HTTPException(status_code=404, detail="Page not found")
+
+        # Жанры страницы заодно кэшируются как ответы на запрос жанра по id
+        cache_alongside(
+            *(
+                CacheEntry(
+                    f"genre:{genre.uuid}",
+                    genre,
+                    Genre.model_dump_json,
+                    300,
+                    (f"genres:{genre.uuid}",),
+                )
+                for genre in genres
+            )
+        )
+
+        return genres, total
+
+    @staticmethod
+    def _search_body(query: Optional[str], sort: Optional[str], order: str) -> dict:
         body = {}
         if query:
             body["query"] = {
@@ -68,23 +154,7 @@ class GenreService:
             body["sort"] = [
                 {sort: {"order": order}}
             ]  # Используем переменные sort и order корректно
-
-        body["from"] = (page - 1) * page_size
-        body["size"] = page_size
-
-        result = await self.elastic.search(index="genres", body=body)
-        genres = [Genre(**hit["_source"]) for hit in result["hits"]["hits"]]
-        total = result["hits"]["total"]["value"]
-
-        if (page - 1) * page_size >= total:
-            raise HTTPException(status_code=404, detail="Page not found")
-
-        await self.redis.set(
-            cache_key,
-            json.dumps({"items": [genre.json() for genre in genres], "total": total}),
-            ex=300,
-        )  # Кеш на 5 минут
-        return genres, total
+        return body
 
 
 @lru_cache()
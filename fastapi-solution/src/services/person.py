@@ -1,4 +1,4 @@
-from functools import lru_cache
+from functools import lru_cache, partial
 from typing import List
 
 from elasticsearch import AsyncElasticsearch, NotFoundError
@@ -7,107 +7,167 @@ from pydantic import TypeAdapter
 from redis.asyncio import Redis
 
 from db.elastic import get_elastic
-from db.redis import generate_cache_key, get_redis
-from models.person import (FilmRating, PersonFilm, PersonRoleInFilms,
-                           PersonWithFilms, PortfolioFilm)
+from db.redis import (CacheEntry, cache_alongside, generate_cache_key,
+                      get_many_or_compute, get_or_compute, get_redis)
+from models.person import FilmRating, PersonFilm, PortfolioFilm
+from services.cursor import search_after_page
 
 PERSONFILM_ADAPTER = TypeAdapter(PersonFilm)
 LISTPERSONFILM_ADAPTER = TypeAdapter(list[PersonFilm])
 FILMRATING_ADAPTER = TypeAdapter(list[FilmRating])
 
 
+# Роли персоны по полям документа фильма
+PORTFOLIO_ROLES = (
+    ("actors", "actors"),
+    ("writers", "writer"),
+    ("directors", "director"),
+)
+
+# Роли в фильмах документа персоны и их названия в ответе API
+ROLE_LABELS = {"actor": "actors", "writer": "writer", "director": "director"}
+
+# Число фильмов в одном запросе к ES при поиске фильмов персон
+PORTFOLIO_PAGE_SIZE = 500
+
+
+def person_films_query(person_ids: List[str]) -> dict:
+    """Запрос фильмов, в которых участвовала любая из персон."""
+    return {
+        "bool": {
+            "should": [
+                {
+                    "nested": {
+                        "path": field,
+                        "query": {"terms": {f"{field}.uuid": person_ids}},
+                    }
+                }
+                for field, _ in PORTFOLIO_ROLES
+            ]
+        }
+    }
+
+
+def person_cache_key(person_id: str) -> str:
+    """Ключ кэша персоны с ее ролями в фильмах."""
+    return generate_cache_key(
+        "person", {"query": "get_by_uuid", "person_id": str(person_id)}
+    )
+
+
 class PersonService:
     def __init__(self, redis: Redis, elastic: AsyncElasticsearch):
         self.redis = redis
         self.elastic = elastic
 
     async def get_by_uuid(self, person_id: str) -> PersonFilm:
-        params_to_key = {"query": "get_by_uuid", "person_id": str(person_id)}
-        cache_key = generate_cache_key("person", params_to_key)
-        person = await self.redis.get(cache_key)
-        if person:
-            return PERSONFILM_ADAPTER.validate_json(person)
-        person = await self.get_person_from_elastic(person_id)
-        if not person:
-            return None
-        await self.redis.set(cache_key, PERSONFILM_ADAPTER.dump_json(person), ex=300)
-        return person
+        cache_key = person_cache_key(person_id)
+        return await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(self.get_person_from_elastic, person_id),
+            PERSONFILM_ADAPTER.validate_json,
+            PERSONFILM_ADAPTER.dump_json,
+            ex=300,
+            tags=[f"persons:{person_id}"],
+        )
 
-    async def get_person_from_elastic(self, person_id: str) -> PersonWithFilms | None:
-        person_name = await self._get_person_name_from_elastic(person_id=person_id)
-        if not person_name:
-            return
-        films = await self._get_uuid_roles_in_films(person_id=person_id)
-        return PersonFilm(uuid=person_id, full_name=person_name, films=films)
+    async def get_by_uuids(self, person_ids: List[str]) -> List[PersonFilm]:
+        # Ключи те же, что у get_by_uuid, - кэш у запросов общий
+        cache_keys = {
+            person_id: person_cache_key(person_id) for person_id in person_ids
+        }
+        persons = await get_many_or_compute(
+            self.redis,
+            cache_keys,
+            self._get_persons_from_elastic,
+            PERSONFILM_ADAPTER.validate_json,
+            PERSONFILM_ADAPTER.dump_json,
+            ex=300,
+            tags=lambda person_id: [f"persons:{person_id}"],
+        )
+        return [persons[person_id] for person_id in cache_keys if person_id in persons]
 
-    async def _get_uuid_roles_in_films(self, person_id: str) -> list[PersonRoleInFilms]:
-        films_doc = await self.elastic.search(
-            index="movies",
-            body={
-                "query": {
-                    "bool": {
-                        "should": [
-                            {
-                                "nested": {
-                                    "path": "directors",
-                                    "query": {
-                                        "bool": {
-                                            "should": {
-                                                "term": {"directors.uuid": person_id}
-                                            }
-                                        }
-                                    },
-                                }
-                            },
-                            {
-                                "nested": {
-                                    "path": "writers",
-                                    "query": {
-                                        "bool": {
-                                            "should": {
-                                                "term": {"writers.uuid": person_id}
-                                            }
-                                        }
-                                    },
-                                }
-                            },
-                            {
-                                "nested": {
-                                    "path": "actors",
-                                    "query": {
-                                        "bool": {
-                                            "should": {
-                                                "term": {"actors.uuid": person_id}
-                                            }
-                                        }
-                                    },
-                                }
-                            },
-                        ]
-                    }
-                }
-            },
-            size=999,
+    async def _get_persons_from_elastic(
+        self, person_ids: List[str]
+    ) -> dict[str, PersonFilm]:
+        docs = await self.elastic.mget(index="persons", ids=person_ids)
+        persons = await self._persons_from_sources(
+            [doc["_source"] for doc in docs["docs"] if doc.get("found")]
         )
-        hits_list = films_doc.body.get("hits", {}).get("hits", [])
-        films = []
-        for hit in hits_list:
-            source = hit["_source"]
-            uuid = source["uuid"]
-            roles = []
-            for actor_in_film in source["actors"]:
-                if actor_in_film["uuid"] == person_id:
-                    roles.append("actors")
-
-            for writer_in_film in source["writers"]:
-                if writer_in_film["uuid"] == person_id:
-                    roles.append("writer")
-
-            for director_in_film in source["directors"]:
-                if director_in_film["uuid"] == person_id:
-                    roles.append("director")
-            films.append(PortfolioFilm(uuid=uuid, roles=roles))
-        return films
+        return {person.uuid: person for person in persons}
+
+    async def get_person_from_elastic(self, person_id: str) -> PersonFilm | None:
+        try:
+            person_doc = await self.elastic.get(index="persons", id=person_id)
+        except NotFoundError:
+            return None
+        persons = await self._persons_from_sources([person_doc["_source"]])
+        return persons[0]
+
+    async def _persons_from_sources(self, sources: list[dict]) -> list[PersonFilm]:
+        """Собирает персон с ролями в фильмах из документов индекса persons.
+
+        Документ персоны хранит ее фильмы с ролями. Фильмы персон из документов,
+        загруженных до появления поля films, ищутся в индексе movies.
+        """
+        missing = [source["uuid"] for source in sources if "films" not in source]
+        portfolios = await self._get_portfolios(missing) if missing else {}
+        return [
+            PersonFilm(
+                uuid=source["uuid"],
+                full_name=source["full_name"],
+                films=(
+                    [
+                        PortfolioFilm(
+                            uuid=film["uuid"],
+                            roles=[
+                                label
+                                for role, label in ROLE_LABELS.items()
+                                if role in film["roles"]
+                            ],
+                        )
+                        for film in source["films"]
+                    ]
+                    if "films" in source
+                    else portfolios[source["uuid"]]
+                ),
+            )
+            for source in sources
+        ]
+
+    async def _get_portfolios(
+        self, person_ids: List[str]
+    ) -> dict[str, list[PortfolioFilm]]:
+        """Находит фильмы и роли сразу всех персон.
+
+        Фильмы читаются страницами search_after: обычно хватает одного
+        запроса, а фильмы плодовитых персон не обрезаются.
+        """
+        body = {
+            "query": person_films_query(person_ids),
+            "_source": ["uuid", *(f"{field}.uuid" for field, _ in PORTFOLIO_ROLES)],
+            "sort": ["uuid"],
+            "size": PORTFOLIO_PAGE_SIZE,
+        }
+        portfolios = {person_id: [] for person_id in person_ids}
+        while True:
+            films_doc = await self.elastic.search(index="movies", body=body)
+            hits = films_doc.body.get("hits", {}).get("hits", [])
+            for hit in hits:
+                source = hit["_source"]
+                roles = {}
+                for field, role in PORTFOLIO_ROLES:
+                    for person in source.get(field) or []:
+                        if person["uuid"] in portfolios:
+                            roles.setdefault(person["uuid"], []).append(role)
+                for person_id, person_roles in roles.items():
+                    portfolios[person_id].append(
+                        PortfolioFilm(uuid=source["uuid"], roles=person_roles)
+                    )
+            if len(hits) < PORTFOLIO_PAGE_SIZE:
+                return portfolios
+            body["search_after"] = hits[-1]["sort"]
 
     async def search(
         self, search_str: str, page_size: int = 50, page_number: int = 1
@@ -118,21 +178,37 @@ class PersonService:
             "page_number": str(page_number),
         }
         cache_key = generate_cache_key("person", params_to_key)
-        persons = await self.redis.get(cache_key)
-        if persons:
-            return LISTPERSONFILM_ADAPTER.validate_json(persons)
-        persons = await self._get_films_by_person_full_name_from_elastic(
-            search_str=search_str,
-            page_size=page_size,
-            page_number=page_number,
-        )
-        await self.redis.set(
-            cache_key, LISTPERSONFILM_ADAPTER.dump_json(persons), ex=300
+        persons = await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(
+                self._get_films_by_person_full_name_from_elastic,
+                search_str=search_str,
+                page_size=page_size,
+                page_number=page_number,
+            ),
+            LISTPERSONFILM_ADAPTER.validate_json,
+            LISTPERSONFILM_ADAPTER.dump_json,
+            ex=300,
+            tags=["persons"],
         )
         if not persons:
             return []
         return persons
 
+    async def search_by_cursor(
+        self, search_str: str, page_size: int = 50, cursor: str | None = None
+    ) -> tuple[List[PersonFilm], str | None]:
+        hits, next_cursor = await search_after_page(
+            self.elastic,
+            "persons",
+            {"query": {"match": {"full_name": search_str}}},
+            page_size,
+            cursor,
+        )
+        persons = await self._persons_from_sources([hit["_source"] for hit in hits])
+        return persons, next_cursor
+
     async def _get_films_by_person_full_name_from_elastic(
         self, search_str: str, page_size: int = 50, page_number: int = 1
     ) -> List[PersonFilm] | None:
@@ -146,16 +222,24 @@ class PersonService:
             },
         )
         persons_hit_list = search_results.body.get("hits", {}).get("hits", [])
-        films_by_person = []
-        for person_hit in persons_hit_list:
-            person_uuid = person_hit["_source"]["uuid"]
-            full_name = person_hit["_source"]["full_name"]
-            films = await self._get_uuid_roles_in_films(person_id=person_uuid)
-            films_by_person.append(
-                PersonFilm(uuid=person_uuid, full_name=full_name, films=films)
-            )
-        if not films_by_person:
+        if not persons_hit_list:
             return
+        films_by_person = await self._persons_from_sources(
+            [person_hit["_source"] for person_hit in persons_hit_list]
+        )
+        # Персоны страницы заодно кэшируются как ответы на запрос персоны по id
+        cache_alongside(
+            *(
+                CacheEntry(
+                    person_cache_key(person.uuid),
+                    person,
+                    PERSONFILM_ADAPTER.dump_json,
+                    300,
+                    (f"persons:{person.uuid}",),
+                )
+                for person in films_by_person
+            )
+        )
         return films_by_person
 
     async def get_film_detail_on_person(self, person_id: str) -> list[FilmRating]:
@@ -164,64 +248,39 @@ class PersonService:
             "person_id": str(person_id),
         }
         cache_key = generate_cache_key("person", params_to_key)
-        films_rated = await self.redis.get(cache_key)
-        if films_rated:
-            return FILMRATING_ADAPTER.validate_json(films_rated)
-        films_rated = await self._get_film_details_by_person_id(person_id=person_id)
-        await self.redis.set(
-            cache_key, FILMRATING_ADAPTER.dump_json(films_rated), ex=300
+        films_rated = await get_or_compute(
+            self.redis,
+            cache_key,
+            partial(self._get_film_details_by_person_id, person_id=person_id),
+            FILMRATING_ADAPTER.validate_json,
+            FILMRATING_ADAPTER.dump_json,
+            ex=300,
+            tags=[f"persons:{person_id}"],
         )
         if not films_rated:
             return []
         return films_rated
 
     async def _get_film_details_by_person_id(self, person_id: str) -> list[FilmRating]:
+        try:
+            person_doc = await self.elastic.get(index="persons", id=person_id)
+        except NotFoundError:
+            return []
+        source = person_doc["_source"]
+        if "films" in source:
+            return [
+                FilmRating(
+                    uuid=film["uuid"],
+                    title=film["title"],
+                    imdb_rating=film["imdb_rating"],
+                )
+                for film in source["films"]
+            ]
+
+        # Документ загружен до появления поля films
         films_doc = await self.elastic.search(
             index="movies",
-            body={
-                "query": {
-                    "bool": {
-                        "should": [
-                            {
-                                "nested": {
-                                    "path": "directors",
-                                    "query": {
-                                        "bool": {
-                                            "should": {
-                                                "term": {"directors.uuid": person_id}
-                                            }
-                                        }
-                                    },
-                                }
-                            },
-                            {
-                                "nested": {
-                                    "path": "writers",
-                                    "query": {
-                                        "bool": {
-                                            "should": {
-                                                "term": {"writers.uuid": person_id}
-                                            }
-                                        }
-                                    },
-                                }
-                            },
-                            {
-                                "nested": {
-                                    "path": "actors",
-                                    "query": {
-                                        "bool": {
-                                            "should": {
-                                                "term": {"actors.uuid": person_id}
-                                            }
-                                        }
-                                    },
-                                }
-                            },
-                        ]
-                    }
-                }
-            },
+            body={"query": person_films_query([person_id])},
             size=999,
         )
         hits_list = films_doc.body.get("hits", {}).get("hits", [])
@@ -237,14 +296,6 @@ class PersonService:
             )
         return films
 
-    async def _get_person_name_from_elastic(self, person_id: str) -> str | None:
-        try:
-            person_doc = await self.elastic.get(index="persons", id=person_id)
-        except NotFoundError:
-            return None
-
-        return person_doc.body["_source"]["full_name"]
-
 
 @lru_cache()
 def get_person_service(